@@ -0,0 +1,270 @@
+"""Benchmarks of nix-visualize on synthetic closures, which need no Nix
+installation.  Run from the top of the repository with
+
+    python -m benchmarks.run
+
+Every size is drawn by visualize_tree.Graph as the command line tool draws
+it, and every phase Graph records in its metrics is timed: querying (reading
+and parsing the nix-store graph), linking nodes, assigning levels, transitive
+reduction if the config enables it, coarsening if asked for, CSV output,
+layout and rendering.  The peak memory allocated during each phase is
+measured in a separate run with tracemalloc, which would otherwise slow the
+timed runs.  Results are compared with a baseline saved earlier on the same
+machine.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+from nix_visualize import nixstore, visualize_tree
+from nix_visualize.metrics import Metrics
+
+from . import synthetic
+
+#: Phases timed for every size, in the order they run
+PHASES = ("query", "link", "levels", "reduce", "coarsen", "write", "layout",
+          "render")
+
+#: Sizes benchmarked unless others are asked for
+DEFAULT_SIZES = ("small", "medium", "large")
+
+#: Modules that a CSV-only run must not import
+HEAVY_MODULES = ("numpy", "matplotlib", "pandas")
+
+#: Baselines depend on the machine, so they are kept out of git
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), "benchmark.cfg")
+
+#: Differences smaller than these are noise, whatever the ratio
+MIN_SECONDS = 0.05
+MIN_MB = 1.0
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import nix_visualize.visualize_tree
+print(time.perf_counter() - start)
+print(",".join(m for m in {} if m in sys.modules))
+""".format(HEAVY_MODULES)
+
+
+class TracedMetrics(Metrics):
+    """Metrics that also record the peak memory Python allocates in every
+    phase, traced by tracemalloc, as traced_peak_mb
+    """
+
+    @contextlib.contextmanager
+    def phase(self, name, **details):
+        tracemalloc.start()
+        try:
+            with super().phase(name, **details):
+                yield
+        finally:
+            self.phases[-1]["traced_peak_mb"] = (
+                tracemalloc.get_traced_memory()[1] / 1e6)
+            tracemalloc.stop()
+
+
+def run_graph(fixture, config, workdir, metrics, coarsen_mode=None):
+    """Draw a fixture to a PNG image and a CSV file with
+    visualize_tree.Graph, recording its phases in metrics, and return the
+    Graph.  config is a (configfile, section) pair.
+    """
+
+    directory, name = os.path.split(fixture)
+    package = os.path.join(directory, os.path.splitext(name)[0])
+    return visualize_tree.Graph(
+        [package], config, [os.path.join(workdir, "frame.csv"),
+                            os.path.join(workdir, "frame.png")],
+        source=nixstore.DotFileSource(directory), metrics=metrics,
+        coarsen_mode=coarsen_mode, seed=0)
+
+
+def benchmark_size(fixture, config, workdir, repeat, coarsen_mode=None):
+    """Return {phase: {"seconds": ..., "peak_mb": ...}} for one fixture,
+    taking the fastest of repeat runs
+    """
+
+    seconds = {}
+    for _ in range(repeat):
+        graph = run_graph(fixture, config, workdir, Metrics(), coarsen_mode)
+        for phase in graph.metrics.phases:
+            name = phase["name"]
+            seconds[name] = min(seconds.get(name, phase["wall_seconds"]),
+                                phase["wall_seconds"])
+
+    traced = run_graph(fixture, config, workdir, TracedMetrics(),
+                       coarsen_mode)
+    peak_mb = {phase["name"]: phase["traced_peak_mb"]
+               for phase in traced.metrics.phases}
+
+    results = {phase: {"seconds": seconds[phase], "peak_mb": peak_mb[phase]}
+               for phase in PHASES if phase in seconds}
+    stats = graph.metrics.stats
+    results["graph"] = {"nodes": stats["nodes"], "edges": stats["edges"],
+                        "depth": stats["depth"],
+                        "crossings": stats["crossings"]}
+    if coarsen_mode is not None:
+        results["graph"]["clusters"] = stats["clusters"]
+    return results
+
+
+def benchmark_startup(repeat):
+    """Time importing the command line module in a fresh interpreter, and
+    list the heavy modules that importing it pulls in
+    """
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT],
+                             check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout.splitlines()
+        elapsed = float(out[0])
+        best = elapsed if best is None else min(best, elapsed)
+    heavy = [m for m in out[1].split(",") if m] if len(out) > 1 else []
+    return {"import": {"seconds": best}, "heavy_modules": heavy}
+
+
+def compare(results, baseline, tolerance):
+    """Print every measurement next to its baseline and return the list of
+    regressions, measurements worse than the baseline by more than
+    tolerance and by more than the noise thresholds
+    """
+
+    regressions = []
+    row = "{:<8} {:<8} {:>10} {:>10} {:>7} {:>10} {:>10}"
+    print(row.format("size", "phase", "seconds", "baseline", "ratio",
+                     "peak MB", "baseline"))
+
+    def check(label, value, old, noise):
+        if old is None or value <= old * (1 + tolerance) or \
+                value - old <= noise:
+            return
+        regressions.append("{} {:.3g} against a baseline of {:.3g}".format(
+            label, value, old))
+
+    startup = results["startup"]
+    old_startup = baseline.get("startup", {})
+    old_seconds = old_startup.get("import", {}).get("seconds")
+    print(row.format("startup", "import", _fmt(startup["import"]["seconds"]),
+                     _fmt(old_seconds),
+                     _ratio(startup["import"]["seconds"], old_seconds), "",
+                     ""))
+    check("startup import seconds", startup["import"]["seconds"],
+          old_seconds, MIN_SECONDS)
+    if startup["heavy_modules"]:
+        regressions.append("importing visualize_tree imports {}".format(
+            ", ".join(startup["heavy_modules"])))
+
+    for size, phases in results["sizes"].items():
+        old_phases = baseline.get("sizes", {}).get(size, {})
+        for phase in PHASES:
+            if phase not in phases:
+                continue
+            new = phases[phase]
+            old = old_phases.get(phase, {})
+            print(row.format(size, phase, _fmt(new["seconds"]),
+                             _fmt(old.get("seconds")),
+                             _ratio(new["seconds"], old.get("seconds")),
+                             _fmt(new["peak_mb"]), _fmt(old.get("peak_mb"))))
+            check("{} {} seconds".format(size, phase), new["seconds"],
+                  old.get("seconds"), MIN_SECONDS)
+            check("{} {} peak MB".format(size, phase), new["peak_mb"],
+                  old.get("peak_mb"), MIN_MB)
+    return regressions
+
+
+def _fmt(value):
+    return "-" if value is None else "{:.3f}".format(value)
+
+
+def _ratio(value, old):
+    return "-" if not old else "{:.2f}".format(value / old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark nix-visualize "
+                                     "on synthetic closures")
+    parser.add_argument("--sizes", default=",".join(DEFAULT_SIZES),
+                        help="comma separated sizes to run, each one of {} "
+                        "or a number of store paths, default is "
+                        "{}".format(", ".join(synthetic.SIZES),
+                                    ",".join(DEFAULT_SIZES)))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="keep the fastest of this many runs")
+    parser.add_argument("--configfile", "-c", default=DEFAULT_CONFIG,
+                        help="nix-visualize config file to benchmark with, "
+                        "default is benchmark.cfg")
+    parser.add_argument("--configsection", "-s")
+    parser.add_argument("--coarsen", choices=visualize_tree.COARSEN_MODES,
+                        help="coarsen the graphs before laying them out")
+    parser.add_argument("--fixtures", help="directory to write the DOT "
+                        "fixtures to, default is a temporary directory")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="baseline results to compare with, default is "
+                        "benchmarks/baseline.json")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction by which a measurement may exceed "
+                        "the baseline, default is 0.25")
+    parser.add_argument("--output", "-o", help="also write the results to "
+                        "this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    config = (args.configfile, args.configsection)
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "startup": benchmark_startup(args.repeat),
+        "sizes": {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        fixtures = args.fixtures or workdir
+        os.makedirs(fixtures, exist_ok=True)
+        for size in args.sizes.split(","):
+            num_paths = synthetic.SIZES.get(size) or int(size)
+            fixture = os.path.join(fixtures, "{}.dot".format(size))
+            with open(fixture, "w") as f:
+                synthetic.write_dot(f, *synthetic.generate(num_paths))
+            print("Benchmarking {} ({} store paths)".format(size, num_paths),
+                  file=sys.stderr)
+            results["sizes"][size] = benchmark_size(fixture, config,
+                                                    workdir, args.repeat,
+                                                    args.coarsen)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        print("No baseline in {}, save one on this machine with "
+              "--save-baseline to compare with".format(args.baseline),
+              file=sys.stderr)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved baseline to {}".format(args.baseline), file=sys.stderr)
+    elif regressions:
+        print("\nRegressions:\n  " + "\n  ".join(regressions),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Generator of synthetic dependency graphs shaped like Nix closures.
+
+Real closures have a few packages that nearly everything depends on (glibc,
+bash, coreutils), many leaf packages referenced once, long chains of build
+outputs, and one root that refers to a large set of top-level packages, as
+a NixOS system's toplevel does.  The generator reproduces that shape:
+
+   * paths are created dependencies first, so every graph is acyclic
+   * each path has a long-tailed number of references, median about 4
+   * references go to one of a few core paths, to a popular path, picked
+     in proportion to how often it is already referenced, or to a recently
+     created path, which builds up chains and sets the depth of the graph
+   * a single root refers to every path that nothing else refers to
+
+Graphs are written in the DOT dialect of nix-store -q --graph, so they can
+be fed to nixstore.parse_graph or to a stub nix-store.
+"""
+
+import argparse
+import math
+import random
+import sys
+
+#: Characters of Nix's base 32 encoding of store path hashes
+NIX_BASE32 = "0123456789abcdfghijklmnpqrsvwxyz"
+
+SYLLABLES = ("lib", "gtk", "py", "perl", "x", "qt", "gst", "font", "ssl", "z",
+             "gnu", "core", "util", "dbus", "glib", "pam", "sys", "net",
+             "audio", "cairo", "pango", "tk", "boost", "icu", "mesa")
+
+#: Named sizes, from a small package up to a full NixOS system
+SIZES = {
+    "small": 300,
+    "medium": 3000,
+    "large": 15000,
+    "nixos": 50000,
+}
+
+
+def _store_name(rng, index):
+    digest = "".join(rng.choice(NIX_BASE32) for _ in range(32))
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+    return "{}-{}{}-{}.{}".format(digest, name, index, rng.randint(0, 9),
+                                  rng.randint(0, 20))
+
+
+def generate(num_paths, seed=1, core=0.2, popularity=0.3):
+    """Return (names, references) for a closure of num_paths store paths,
+    where references[i] lists the indices of the paths that path i refers
+    to.  The last path is the root.  core and popularity are the fractions
+    of references that go to core paths and to widely used paths rather
+    than to recent ones.
+    """
+
+    rng = random.Random(seed)
+    num_paths = max(num_paths, 2)
+    names = [_store_name(rng, i) for i in range(num_paths)]
+    references = [[] for _ in range(num_paths)]
+    referenced = [False] * num_paths
+
+    # One entry per reference made so far, so picking from it favours
+    # popular paths.  Seeded with a bootstrap chain such as stdenv builds,
+    # whose last few paths are the core every package refers to.
+    bootstrap = max(int(math.log2(num_paths)), 5)
+    num_core = 4
+    popular = []
+    for i in range(1, bootstrap):
+        references[i].append(i - 1)
+        referenced[i - 1] = True
+        popular.append(i - 1)
+
+    # Recent paths are drawn from a window that keeps the depth of the graph
+    # growing logarithmically with its size, as it does in real closures
+    window = max(int(2 * num_paths / math.log2(num_paths)), 4)
+    for i in range(bootstrap, num_paths - 1):
+        num_refs = min(int(rng.lognormvariate(math.log(4), 0.8)), i)
+        targets = set()
+        for _ in range(num_refs):
+            pick = rng.random()
+            if pick < core:
+                targets.add(bootstrap - 1 - rng.randrange(num_core))
+            elif popular and pick < core + popularity:
+                targets.add(rng.choice(popular))
+            else:
+                targets.add(rng.randrange(max(0, i - window), i))
+        for target in sorted(targets):
+            references[i].append(target)
+            referenced[target] = True
+            popular.append(target)
+
+    root = num_paths - 1
+    references[root] = [i for i in range(root) if not referenced[i]]
+    return names, references
+
+
+def write_dot(f, names, references):
+    """Write a graph in the format of nix-store -q --graph"""
+    f.write("digraph G {\n")
+    for name in names:
+        f.write('"{}" [label = "{}", shape = box, style = filled, '
+                'fillcolor = "#ff0000"];\n'.format(name, name[33:]))
+    for referrer, refs in enumerate(references):
+        for reference in refs:
+            f.write('"{}" -> "{}" [color = "black"];\n'.format(
+                names[reference], names[referrer]))
+    f.write("}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Nix "
+                                     "closure as a nix-store --graph fixture")
+    parser.add_argument("size", help="number of store paths, or one of "
+                        "{}".format(", ".join(SIZES)))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", "-o", help="output file, default is "
+                        "standard output")
+    args = parser.parse_args()
+
+    num_paths = SIZES[args.size] if args.size in SIZES else int(args.size)
+    names, references = generate(num_paths, args.seed)
+    if args.output is None:
+        write_dot(sys.stdout, names, references)
+    else:
+        with open(args.output, "w") as f:
+            write_dot(f, names, references)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,7 @@
   lib,
   buildPythonPackage,
   matplotlib,
-  networkx,
-  pygraphviz,
-  pandas,
+  numpy,
   self,
 }:
 buildPythonPackage {
@@ -14,8 +12,6 @@ buildPythonPackage {
 
   propagatedBuildInputs = [
     matplotlib
-    networkx
-    pygraphviz
-    pandas
+    numpy
   ];
 }
@@ -0,0 +1,151 @@
+"""Persistent cache of the dependency graphs of Nix store paths"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .graph_objects import Node, Edge
+
+logger = logging.getLogger(__name__)
+
+#: Store paths are immutable, so only roots inside the store can be cached
+STORE_DIR = os.environ.get("NIX_STORE_DIR", "/nix/store")
+
+#: Default upper bound on the number of store paths kept in the cache
+DEFAULT_MAX_PATHS = 500000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS paths (
+    name TEXT PRIMARY KEY,
+    last_used REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS paths_last_used ON paths (last_used);
+CREATE TABLE IF NOT EXISTS refs (
+    referrer TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    PRIMARY KEY (referrer, reference)
+) WITHOUT ROWID;
+"""
+
+#: Every path reachable from a root, whether its references are cached, and
+#: one row per reference
+CLOSURE_QUERY = """
+WITH RECURSIVE closure(name) AS (
+    VALUES (?)
+    UNION
+    SELECT refs.reference FROM refs JOIN closure
+        ON refs.referrer = closure.name
+)
+SELECT closure.name, paths.name IS NOT NULL, refs.reference
+FROM closure
+LEFT JOIN paths ON paths.name = closure.name
+LEFT JOIN refs ON refs.referrer = closure.name
+"""
+
+
+def default_cache_dir():
+    """Return the directory the cache lives in unless told otherwise"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "nix-visualize")
+
+
+def store_path_name(package):
+    """Return the store path name (<hash>-<name>) a package argument refers
+    to, or None if it is not inside the Nix store and so cannot be cached.
+    A file inside a store path, like nix-store -q, refers to the store path.
+    """
+    path = os.path.realpath(package)
+    if not path.startswith(STORE_DIR + os.sep):
+        return None
+    return path[len(STORE_DIR) + 1:].split(os.sep)[0] or None
+
+
+class ClosureCache(object):
+    """SQLite database holding the references of every store path seen so
+    far.  A path is recorded together with all of its references, so the
+    closure of any cached path can be rebuilt without running nix-store, and
+    closures that overlap share their entries.  Once more than max_paths
+    paths are stored the least recently used are evicted.
+
+    A cache can be used from several threads, such as the request threads
+    of the daemon, which take turns on its one connection.
+    """
+
+    def __init__(self, cache_dir=None, max_paths=DEFAULT_MAX_PATHS):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.filename = os.path.join(cache_dir, "closures.sqlite")
+        self.max_paths = max_paths
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Return the (nodes, edges) closure of a store path name, or None if
+        any path in it is missing from the cache
+        """
+        with self.lock:
+            return self._get(name)
+
+    def _get(self, name):
+        rows = self.db.execute(CLOSURE_QUERY, (name,)).fetchall()
+        nodes = {}
+        edges = []
+        for referrer, complete, reference in rows:
+            if not complete:
+                return None
+            if referrer not in nodes:
+                nodes[referrer] = Node(referrer)
+            if reference is not None:
+                edges.append(Edge(reference, referrer))
+
+        with self.db:
+            self.db.executemany(
+                "UPDATE paths SET last_used = ? WHERE name = ?",
+                ((time.time(), n) for n in nodes))
+        logger.debug("Closure of {} read from cache".format(name))
+        return list(nodes.values()), edges
+
+    def put(self, nodes, edges):
+        """Record the references of every path in a closure"""
+        with self.lock:
+            self._put(nodes, edges)
+
+    def _put(self, nodes, edges):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO paths (name, last_used) VALUES (?, ?)",
+                ((n.raw_name, now) for n in nodes))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO refs (referrer, reference) "
+                "VALUES (?, ?)", ((e.nto, e.nfrom) for e in edges))
+        self._evict()
+
+    def _evict(self):
+        """Drop the least recently used paths once the cache is too big"""
+
+        (num_paths,) = self.db.execute(
+            "SELECT count(*) FROM paths").fetchone()
+        excess = num_paths - self.max_paths
+        if excess <= 0:
+            return
+
+        logger.info("Evicting {} paths from {}".format(excess, self.filename))
+        with self.db:
+            self.db.execute(
+                "CREATE TEMP TABLE evicted AS SELECT name FROM paths "
+                "ORDER BY last_used LIMIT ?", (excess,))
+            self.db.execute("DELETE FROM refs WHERE referrer IN "
+                            "(SELECT name FROM evicted)")
+            self.db.execute("DELETE FROM paths WHERE name IN "
+                            "(SELECT name FROM evicted)")
+            self.db.execute("DROP TABLE evicted")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,123 @@
+"""Collapse the packages of a dependency graph into clusters, so that very
+large closures can be laid out and drawn at a readable size
+"""
+
+import collections
+
+from . import util
+from .graph_objects import Node, Edge
+
+#: Ways of grouping packages into clusters
+COARSEN_MODES = ("name", "output", "degree")
+
+#: Suffixes of the store paths of the outputs of multiple-output derivations
+OUTPUTS = ("bin", "dev", "lib", "man", "doc", "devdoc", "info", "out",
+           "static", "debug", "py", "python")
+
+
+def split_store_name(raw_name):
+    """Split a store path name of the form <hash>-<name>-<version>-<output>
+    into its name, version and output, the last two possibly empty.  As in
+    Nix, the version starts at the first component that starts with a digit.
+    """
+    parts = util.remove_nix_hash(raw_name).split("-")
+    output = ""
+    if len(parts) > 1 and parts[-1] in OUTPUTS:
+        output = parts.pop()
+    for i, part in enumerate(parts):
+        if i > 0 and part[:1].isdigit():
+            return "-".join(parts[:i]), "-".join(parts[i:]), output
+    return "-".join(parts), "", output
+
+
+class ClusterNode(Node):
+    """A node standing for a group of packages, its members"""
+
+    __slots__ = ("members",)
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.members = []
+
+    def __repr__(self):
+        if len(self.members) == 1:
+            return repr(self.members[0])
+        return "{} ({})".format(self.raw_name, len(self.members))
+
+
+def _cluster_names(nodes, mode):
+    """Return the name of the cluster of every node, by node index"""
+
+    if mode == "name":
+        return [split_store_name(n.raw_name)[0] for n in nodes]
+    if mode == "output":
+        names = []
+        for n in nodes:
+            name, version, _output = split_store_name(n.raw_name)
+            names.append("-".join(p for p in (name, version) if p))
+        return names
+
+    # A package that is only referred to from within one cluster, other
+    # than a root's, is private to it and joins it.  Parents are on lower
+    # levels, so their clusters are known first.
+    names = [None] * len(nodes)
+    for n in sorted(nodes, key=lambda n: n.level):
+        referrers = {names[p.index] for p in n.parents}
+        if len(referrers) == 1:
+            (name,) = referrers
+            if name not in (p.raw_name for p in n.parents if p.level == 0):
+                names[n.index] = name
+                continue
+        names[n.index] = n.raw_name
+    return names
+
+
+def coarsen(nodes, mode):
+    """Group indexed nodes with levels assigned into clusters by mode:
+
+       * "name": every version and output of a package, e.g. glibc
+       * "output": every output of a derivation, e.g. glibc-2.37-8
+       * "degree": packages into the package they are private to, that is
+         the only cluster that refers to them
+
+    Returns the ClusterNodes, ordered by their first member, the Edges
+    between them and a dictionary of the number of links between packages
+    each Edge stands for, keyed by (dependency, referrer) cluster names.  A
+    cluster is placed on the mean level of its members, or on level 0 if it
+    holds a root, and levels are renumbered to leave out empty ones.  The
+    name of its cluster is stored in every node.
+    """
+
+    if mode not in COARSEN_MODES:
+        raise util.TreeCLIError("Unknown coarsening mode {}, choose one of "
+                                "{}".format(mode, ", ".join(COARSEN_MODES)))
+
+    names = _cluster_names(nodes, mode)
+    clusters = collections.OrderedDict()
+    for n, name in zip(nodes, names):
+        cluster = clusters.get(name)
+        if cluster is None:
+            cluster = clusters[name] = ClusterNode(name)
+        cluster.members.append(n)
+        n.cluster = cluster.raw_name
+
+    for cluster in clusters.values():
+        levels = [n.level for n in cluster.members]
+        if min(levels) == 0:
+            cluster.level = 0
+        else:
+            cluster.level = max(1, int(round(sum(levels) / len(levels))))
+
+    levels = sorted({c.level for c in clusters.values()})
+    renumber = {level: i for i, level in enumerate(levels)}
+    for cluster in clusters.values():
+        cluster.level = renumber[cluster.level]
+
+    weights = collections.Counter()
+    for n, name in zip(nodes, names):
+        for parent in n.parents:
+            parent_name = names[parent.index]
+            if parent_name != name:
+                weights[(name, parent_name)] += 1
+    edges = [Edge(child, parent) for child, parent in weights]
+    return list(clusters.values()), edges, weights
@@ -0,0 +1,51 @@
+"""Plain text writers for the packages of a dependency graph, which need
+nothing beyond the standard library
+"""
+
+import csv
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+#: The fields written for every package, in order
+COLUMNS = ("raw_name", "level", "in_degree", "out_degree")
+
+#: The fields written for every package of a coarsened graph
+CLUSTER_COLUMNS = COLUMNS + ("cluster",)
+
+
+def _records(nodes):
+    """Yield the dictionary of every node, deepest level first and otherwise
+    in graph order
+    """
+    for node in sorted(nodes, key=lambda n: -n.level):
+        yield node.to_dict()
+
+
+def write_csv(filename, nodes, columns=COLUMNS):
+    """Write one row per package with every field quoted"""
+    with open(filename, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, quoting=csv.QUOTE_ALL,
+                                lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(_records(nodes))
+    logger.info("Wrote: {}".format(filename))
+
+
+def write_jsonl(filename, nodes, columns=COLUMNS):
+    """Write one JSON object per package per line.  Every field is written
+    whatever the columns, which only matter to the CSV writer.
+    """
+    with open(filename, "w", encoding="utf-8") as f:
+        for record in _records(nodes):
+            f.write(json.dumps(record))
+            f.write("\n")
+    logger.info("Wrote: {}".format(filename))
+
+
+#: Writers by output filename extension
+WRITERS = {
+    ".csv": write_csv,
+    ".jsonl": write_jsonl,
+}
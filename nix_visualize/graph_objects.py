@@ -1,16 +1,21 @@
 """Definitions for edges and nodes for Nix dependency visualizer"""
 
+import collections
 import os
+import sys
+from array import array
 from . import util
 
 class Edge(object):
     """Class represents the relationship between two packages."""
 
+    __slots__ = ("nfrom_raw", "nto_raw", "nfrom", "nto")
+
     def __init__(self, node_from, node_to):
         self.nfrom_raw=node_from
         self.nto_raw=node_to
-        self.nfrom = os.path.basename(self.nfrom_raw)
-        self.nto = os.path.basename(self.nto_raw)
+        self.nfrom = sys.intern(os.path.basename(self.nfrom_raw))
+        self.nto = sys.intern(os.path.basename(self.nto_raw))
 
     def __repr__(self):
         return "{} -> {}".format(self.nfrom, self.nto)
@@ -19,13 +24,19 @@ class Edge(object):
 class Node(object):
     """Class represents an individual package"""
 
+    __slots__ = ("raw_name", "index", "children", "parents", "in_degree",
+                 "out_degree", "level", "x", "y", "dx_parent", "dx_sibling",
+                 "cluster")
+
     def __init__(self, name):
-        self.raw_name = name
+        self.raw_name = sys.intern(name)
+        self.index = -1
         self.children = []
         self.parents = []
         self.in_degree = 0
         self.out_degree = 0
         self.level = -1
+        self.cluster = None
 
         self.x = 0
         self.y = 0
@@ -38,22 +49,6 @@ class Node(object):
         self.children.append(nfrom)
         self.in_degree = len(self.children)
 
-    def add_level(self):
-        """Add the Node's level.  Level is this package's position in the
-        hierarchy.  0 is the top-level package.  That package's dependencies
-        are level 1, their dependencies are level 2.
-        """
-
-        if self.level >= 0:
-            return self.level
-        elif len(self.parents) > 0:
-            parent_levels =  [p.add_level() for p in self.parents]
-            self.level = max(parent_levels) + 1
-            return self.level
-        else:
-            self.level = 0
-            return 0
-
     def __repr__(self):
         return util.remove_nix_hash(self.raw_name)
 
@@ -68,8 +63,139 @@ class Node(object):
             return False
 
     def to_dict(self):
-        """Return Node as dictionary"""
-        return {
+        """Return Node as dictionary.  in_degree is the number of packages
+        this one depends on, out_degree the number that depend on it.  The
+        name of the cluster holding the package is added if the graph was
+        coarsened.
+        """
+        ret = {
             'raw_name': self.raw_name,
             'level': self.level,
+            'in_degree': self.in_degree,
+            'out_degree': self.out_degree,
         }
+        if self.cluster is not None:
+            ret['cluster'] = self.cluster
+        return ret
+
+
+def compressed_adjacency(nodes, attr):
+    """Return the links named by attr ("parents" or "children") of a list of
+    indexed Nodes in compressed sparse row form.  The linked nodes of
+    nodes[i] are indices[indptr[i]:indptr[i+1]].
+    """
+    indptr = array("l", [0])
+    indices = array("l")
+    for node in nodes:
+        indices.extend(linked.index for linked in getattr(node, attr))
+        indptr.append(len(indices))
+    return indptr, indices
+
+
+def assign_levels(nodes):
+    """Add every Node's level.  Level is a package's position in the
+    hierarchy.  0 is the top-level package.  That package's dependencies are
+    level 1, their dependencies are level 2, and in general a package sits one
+    level below the lowest of the packages that depend on it.
+
+    Levels are assigned in a single topological (Kahn) pass over the indexed
+    nodes.  Raises TreeCLIError if the graph contains a cycle.
+    """
+
+    remaining = [len(n.parents) for n in nodes]
+    queue = collections.deque()
+    for n in nodes:
+        n.level = -1
+        if remaining[n.index] == 0:
+            n.level = 0
+            queue.append(n)
+
+    num_assigned = 0
+    while queue:
+        node = queue.popleft()
+        num_assigned += 1
+        for child in node.children:
+            child.level = max(child.level, node.level + 1)
+            remaining[child.index] -= 1
+            if remaining[child.index] == 0:
+                queue.append(child)
+
+    if num_assigned < len(nodes):
+        # Every unassigned node has an unassigned parent, so following those
+        # parents must eventually revisit a node
+        node = next(n for n in nodes if remaining[n.index] > 0)
+        path = []
+        visited = {}
+        while node.index not in visited:
+            visited[node.index] = len(path)
+            path.append(node)
+            node = next(p for p in node.parents if remaining[p.index] > 0)
+        cycle = path[visited[node.index]:] + [node]
+        raise util.TreeCLIError(
+            "Dependency graph contains a cycle, so {} of {} nodes cannot be "
+            "placed on a level: {}".format(
+                len(nodes) - num_assigned, len(nodes),
+                " -> ".join(n.raw_name for n in cycle)))
+
+
+def hops(start, attr, max_hops=None):
+    """Return the number of links from start to every Node reached by
+    following the links named by attr ("parents" or "children"), keyed by
+    node index, going no further than max_hops links if it is set
+    """
+    distances = {start.index: 0}
+    queue = collections.deque([start])
+    while queue:
+        node = queue.popleft()
+        distance = distances[node.index] + 1
+        if max_hops is not None and distance > max_hops:
+            continue
+        for linked in getattr(node, attr):
+            if linked.index not in distances:
+                distances[linked.index] = distance
+                queue.append(linked)
+    return distances
+
+
+def transitive_reduction(nodes):
+    """Remove every link from a package to a dependency that it also reaches
+    through another of its dependencies, and return the number of links
+    removed.  Reachability is unchanged, and so are levels, as a longest path
+    never takes such a shortcut.  in_degree and out_degree keep counting the
+    original references.
+
+    Expects indexed nodes with levels assigned.  Levels are visited from the
+    deepest up, and the set of packages each one reaches is kept as an
+    integer bitset, so checking a link costs one bitwise and.  Deeper
+    packages get lower bits, so the bitsets of the many packages near the
+    bottom of a closure stay small.
+    """
+
+    order = sorted(nodes, key=lambda n: -n.level)
+    bits = [0] * len(nodes)
+    for position, n in enumerate(order):
+        bits[n.index] = 1 << position
+    reach = [0] * len(nodes)
+    unvisited_parents = [len(n.parents) for n in nodes]
+
+    redundant = set()
+    for n in order:
+        # A dependency can only be reached through dependencies on levels
+        # above it
+        covered = 0
+        for child in sorted(n.children, key=lambda c: c.level):
+            if covered & bits[child.index]:
+                redundant.add((child.index, n.index))
+            covered |= reach[child.index]
+            unvisited_parents[child.index] -= 1
+            if unvisited_parents[child.index] == 0:
+                reach[child.index] = 0
+        reach[n.index] = covered | bits[n.index]
+
+    if redundant:
+        for n in nodes:
+            n.children = [c for c in n.children
+                          if (c.index, n.index) not in redundant]
+            n.parents = [p for p in n.parents
+                         if (n.index, p.index) not in redundant]
+    return len(redundant)
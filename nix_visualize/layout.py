@@ -0,0 +1,677 @@
+"""Array based force-directed layout solver for the Nix dependency visualizer"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+from array import array
+
+import numpy as np
+
+from . import util
+
+logger = logging.getLogger(__name__)
+
+#: The distance between levels in arbitrary units.  Used to set a scale on
+#: the diagram
+LEVEL_HEIGHT = 10
+
+#: Sibling pairs closer than this do not repel each other
+MIN_SIBLING_DISTANCE = 1e-3
+
+#: In convergence mode the timestep never grows beyond this multiple of
+#: tmax/num_iterations
+MAX_TIMESTEP_FACTOR = 10.0
+
+#: Names of the available ways of computing sibling repulsion
+REPULSION_MODES = ("exact", "approximate")
+
+#: Names of the available ways of choosing starting x positions
+INITIALIZERS = ("barycentric", "median", "random")
+
+#: Names of the measures a layout search can pick the best layout by
+TRIAL_SCORES = ("crossings", "edge_length")
+
+#: In approximate repulsion, the near cells of a node are halved once they
+#: hold more than this many siblings per cell
+NEAR_FIELD_LIMIT = 4
+
+#: Upper bound on the number of pairwise distances held in memory at once
+#: when computing sibling repulsion
+MAX_PAIRS_PER_CHUNK = 1 << 20
+
+#: Identifies files written by write_layout
+LAYOUT_FORMAT = "nix-visualize-layout"
+LAYOUT_FORMAT_VERSION = 1
+
+
+def content_hash(value):
+    """Return a hex digest identifying a JSON serializable value"""
+    return hashlib.sha256(json.dumps(value, sort_keys=True,
+                                     separators=(",", ":")).encode(
+                                         "utf-8")).hexdigest()
+
+
+def write_layout(filename, layout):
+    """Save a layout as compact JSON.  layout is a dictionary holding
+    graph_hash and config_hash, the node names, levels, x and y positions as
+    parallel lists, and the edges as [child, parent] index pairs.
+    """
+    record = dict(layout, format=LAYOUT_FORMAT, version=LAYOUT_FORMAT_VERSION)
+    # Written to a temporary file that replaces the layout once complete,
+    # so that an interrupted run, a full disk or two runs writing the same
+    # layout never leave a truncated file behind
+    directory, name = os.path.split(os.path.abspath(filename))
+    f = tempfile.NamedTemporaryFile("w", dir=directory, prefix="." + name,
+                                    suffix=".tmp", delete=False)
+    try:
+        with f:
+            json.dump(record, f, separators=(",", ":"))
+        os.replace(f.name, filename)
+    except BaseException:
+        os.remove(f.name)
+        raise
+    logger.info("Wrote layout: {}".format(filename))
+
+
+def read_layout(filename):
+    """Load a layout saved by write_layout"""
+    try:
+        with open(filename) as f:
+            layout = json.load(f)
+    except (OSError, ValueError) as e:
+        raise util.TreeCLIError("Cannot read layout {}: {}".format(filename,
+                                                                   e))
+    if (not isinstance(layout, dict) or
+            layout.get("format") != LAYOUT_FORMAT or
+            layout.get("version") != LAYOUT_FORMAT_VERSION):
+        raise util.TreeCLIError("{} is not a nix-visualize layout file of "
+                                "version {}".format(filename,
+                                                    LAYOUT_FORMAT_VERSION))
+    return layout
+
+
+class LayoutEngine(object):
+    """Force-directed layout that keeps node positions, levels and parent
+    lists in NumPy arrays and advances a whole level per array operation.
+
+    Nodes are identified by their index.  Parents are given in compressed
+    sparse row form: the parents of node ``i`` are
+    ``parent_idx[parent_ptr[i]:parent_ptr[i+1]]``.
+    """
+
+    def __init__(self, levels, parent_ptr, parent_idx, config):
+        self.config = config
+        self.levels = np.asarray(levels, dtype=np.intp)
+        self.parent_ptr = np.asarray(parent_ptr, dtype=np.intp)
+        self.parent_idx = np.asarray(parent_idx, dtype=np.intp)
+        self.depth = int(self.levels.max()) + 1 if len(self.levels) else 0
+
+        self.x = np.zeros(len(self.levels))
+        self.y = np.zeros(len(self.levels))
+        #: The number of iterations the last run took
+        self.iterations = 0
+
+        # Node indices on each level, in index order, so that nodes are
+        # visited in the same order as the reference solver visits them
+        order = np.argsort(self.levels, kind="stable")
+        bounds = np.searchsorted(self.levels[order], np.arange(self.depth + 1))
+        self.level_nodes = [order[bounds[i]:bounds[i + 1]]
+                            for i in range(self.depth)]
+
+        # For each level, the flattened parent indices of its nodes and the
+        # position within the level of the node each parent belongs to
+        self.level_parents = [_linked(nodes, self.parent_ptr,
+                                      self.parent_idx)
+                              for nodes in self.level_nodes]
+
+    def run(self, x0, active=None, num_iterations=None):
+        """Solve for positions starting from the x positions ``x0``.  Level 0
+        nodes are held fixed.  Returns the arrays of x and y positions.
+
+        If the boolean array active is given, only the nodes where it is true
+        move, and only the levels holding one of them are visited, so each
+        iteration costs time in proportion to the number of active nodes and
+        their siblings rather than to the size of the graph.  num_iterations
+        overrides the config option of that name without changing the
+        timestep.
+
+        If the convergence_tolerance config option is positive, iteration
+        stops as soon as the mean displacement per node falls below it, and
+        every node gets its own adaptive timestep: it grows by
+        timestep_growth while the node keeps moving in the same direction and
+        shrinks by timestep_shrink when the node reverses, which signals that
+        it is oscillating about its equilibrium.  num_iterations is then an
+        upper bound.
+        """
+
+        config = self.config
+        max_displacement = LEVEL_HEIGHT * config["max_displacement"]
+        dt = config["tmax"] / config["num_iterations"]
+        if num_iterations is None:
+            num_iterations = config["num_iterations"]
+
+        self.x = np.array(x0, dtype=float)
+        self.y = np.zeros(len(self.x))
+        if self.depth > 0:
+            self.y[self.level_nodes[0]] = self.depth * LEVEL_HEIGHT
+
+        plan = self._plan(active)
+        if active is not None:
+            # Levels that are not visited keep their starting sublevels
+            for level in range(1, self.depth):
+                self._set_sublevels(level, self.level_nodes[level],
+                                    self.x[self.level_nodes[level]])
+
+        tolerance = config["convergence_tolerance"]
+        max_dt = dt * MAX_TIMESTEP_FACTOR
+        num_moving = max(sum(len(movers) for _l, movers, _p in plan), 1)
+        residual = float("inf")
+        timestep = np.full(len(self.x), dt)
+        previous_dx = np.zeros(len(self.x))
+
+        log_every = max(num_iterations // 10, 1)
+        self.iterations = 0
+        for iternum in range(num_iterations):
+            self.iterations = iternum + 1
+            if iternum % log_every == 0:
+                logger.debug("Completed iteration {} of {}".format(
+                    iternum, num_iterations))
+            total_abs_displacement = 0.0
+
+            for level, movers, (flat, owner, counts) in plan:
+                nodes = self.level_nodes[level]
+                xs = self.x[nodes]
+
+                self._set_sublevels(level, nodes, xs)
+                moving = nodes[movers]
+                xm = xs[movers]
+
+                # We pull nodes toward their parents
+                attraction = np.bincount(owner,
+                                         weights=self.x[flat] - xm[owner],
+                                         minlength=len(movers))
+
+                # And push nodes away from their siblings with force 1/r
+                if config["repulsion_mode"] == "approximate":
+                    repulsion = self._sibling_force_approximate(
+                        xs, config["repulsion_near_cells"])[movers]
+                else:
+                    repulsion = self._sibling_force(xs, movers)
+
+                # Limit each of the displacements to the max displacement
+                dx_parent = np.clip(
+                    config["attractive_force_normalization"] * attraction /
+                    counts, -max_displacement, max_displacement)
+                dx_sibling = -np.clip(
+                    repulsion * config["repulsive_force_normalization"],
+                    -max_displacement, max_displacement)
+
+                step = timestep[moving]
+                self.x[moving] = xm + dx_parent * step + dx_sibling * step
+                total_abs_displacement += np.abs(self.x[moving] - xm).sum()
+
+                if tolerance > 0:
+                    dx = dx_parent + dx_sibling
+                    reversed_ = dx * previous_dx[moving] < 0
+                    timestep[moving] = np.where(
+                        reversed_, step * config["timestep_shrink"],
+                        np.minimum(step * config["timestep_growth"], max_dt))
+                    previous_dx[moving] = dx
+
+            if tolerance <= 0:
+                continue
+
+            residual = total_abs_displacement / num_moving
+            if residual < tolerance:
+                logger.info("Layout converged after {} iterations, mean "
+                            "displacement {:.3g}".format(iternum + 1, residual))
+                break
+        else:
+            if tolerance > 0:
+                logger.info("Layout did not converge in {} iterations, mean "
+                            "displacement {:.3g}".format(num_iterations,
+                                                         residual))
+
+        return self.x, self.y
+
+    def _plan(self, active):
+        """Return (level, movers, parents) for every level below the top
+        holding a node that moves, where movers are the positions of those
+        nodes within the level and parents are the flattened parent indices,
+        owner positions within movers and parent counts of the movers
+        """
+        plan = []
+        for level in range(1, self.depth):
+            nodes = self.level_nodes[level]
+            flat, owner, counts = self.level_parents[level]
+            if active is None:
+                movers = np.arange(len(nodes))
+            else:
+                mask = np.asarray(active, dtype=bool)[nodes]
+                movers = np.flatnonzero(mask)
+                keep = mask[owner]
+                position = np.cumsum(mask) - 1
+                flat, owner, counts = (flat[keep], position[owner[keep]],
+                                       counts[movers])
+            if len(movers) > 0:
+                plan.append((level, movers, (flat, owner, counts)))
+        return plan
+
+    def _set_sublevels(self, level, nodes, xs):
+        """Offset nodes vertically by cycling through sublevels in order of
+        x position
+        """
+        config = self.config
+        rank = np.empty(len(nodes), dtype=np.intp)
+        rank[np.argsort(xs, kind="stable")] = np.arange(len(nodes))
+        self.y[nodes] = ((self.depth - level) * LEVEL_HEIGHT +
+                         (rank % config["y_sublevels"]) *
+                         config["y_sublevel_spacing"] * LEVEL_HEIGHT)
+
+    @staticmethod
+    def _sibling_force(xs, rows=None):
+        """Return, for every x in xs, or only for xs[rows] if rows is given,
+        the sum of 1/(sib - x) over all siblings further away than
+        MIN_SIBLING_DISTANCE.  Terms are accumulated in sibling order, as the
+        reference solver does, so that both solvers round identically.
+        """
+        if rows is None:
+            rows = np.arange(len(xs))
+        force = np.empty(len(rows))
+        chunk = max(MAX_PAIRS_PER_CHUNK // max(len(xs), 1), 1)
+        for start in range(0, len(rows), chunk):
+            dist = (xs[np.newaxis, :] -
+                    xs[rows[start:start + chunk], np.newaxis])
+            inverse = np.zeros_like(dist)
+            np.divide(1.0, dist, out=inverse,
+                      where=np.abs(dist) > MIN_SIBLING_DISTANCE)
+            force[start:start + chunk] = np.cumsum(inverse, axis=1)[:, -1]
+        return force
+
+    @classmethod
+    def _sibling_force_approximate(cls, xs, near_cells):
+        """Approximate _sibling_force for n siblings.
+
+        The level is divided into n equal cells.  Siblings within near_cells
+        cells of a node are summed exactly.  Every further cell acts as if
+        all of its nodes sat at its centre, and these far field sums are one
+        FFT convolution of the cell occupancy with 1/r.  The distance between
+        two cell centres is within one cell width of the true distance and at
+        least near_cells + 1 cell widths, so each far pair's term is off by
+        at most a factor 1/(near_cells + 1) of its value.
+
+        Where nodes cluster, the near cells of a node can hold most of the
+        level.  A node whose near cells hold more than NEAR_FIELD_LIMIT
+        siblings per cell has them halved instead, the halves further than
+        near_cells halves away are treated as far cells with the same error
+        bound, and so on until its near cells hold few enough siblings, or
+        until further halves could hold siblings too close to repel.
+        Summing the near fields then costs O(n near_cells), the far field
+        O(n log n), and every halving O(n near_cells log n), which is only
+        needed once per halving of the spacing between clustered nodes.
+        Only siblings within a few MIN_SIBLING_DISTANCE of many others are
+        still summed exactly over all of them.
+        """
+
+        num = len(xs)
+        if num <= 2 * (2 * near_cells + 1):
+            return cls._sibling_force(xs)
+
+        low = xs.min()
+        span = xs.max() - low
+        if span <= MIN_SIBLING_DISTANCE:
+            return np.zeros(num)
+
+        width = span / num
+        position = (xs - low) / width
+        cell = np.minimum(position.astype(np.int64), num - 1)
+        order = np.argsort(position, kind="stable")
+        occupancy = np.bincount(cell, minlength=num)
+
+        # Far field at each cell centre: sum over cells s of
+        # occupancy[s] / ((s - c) * width) for |s - c| > near_cells, written
+        # as a convolution with the kernel -1/(m * width)
+        offsets = np.arange(-(num - 1), num)
+        kernel = np.zeros(len(offsets))
+        far = np.abs(offsets) > near_cells
+        kernel[far] = -1.0 / (offsets[far] * width)
+        size = 1 << int(np.ceil(np.log2(num + len(kernel) - 1)))
+        field = np.fft.irfft(np.fft.rfft(occupancy, size) *
+                             np.fft.rfft(kernel, size), size)
+        force = field[num - 1:2 * num - 1][cell]
+
+        # Near fields, halving the cells of crowded nodes.  Cells are
+        # numbered in the same order as the nodes sorted by position, so the
+        # nodes of neighbouring cells are contiguous in sorted order.
+        limit = NEAR_FIELD_LIMIT * (2 * near_cells + 1)
+        sorted_position = position[order]
+        sorted_cell = cell[order]
+        targets = np.arange(num)
+        scale = 1
+        while True:
+            target_cell = cell[targets]
+            first = np.searchsorted(sorted_cell, target_cell - near_cells)
+            last = np.searchsorted(sorted_cell, target_cell + near_cells,
+                                   side="right")
+            crowded = last - first > limit
+            done = ~crowded
+            force[targets[done]] += cls._near_field(
+                xs, order, targets[done], first[done], last[done])
+            targets = targets[crowded]
+            if len(targets) == 0:
+                break
+            if max(near_cells, 1) * width / (2 * scale) < \
+                    MIN_SIBLING_DISTANCE:
+                # Halves could hold pairs too close to repel, which must
+                # not be approximated, so the rest are summed exactly,
+                # leaving out the siblings too close to repel
+                first, last = first[crowded], last[crowded]
+                sorted_x = xs[order]
+                close_first = np.maximum(np.searchsorted(
+                    sorted_x, xs[targets] - MIN_SIBLING_DISTANCE), first)
+                close_last = np.minimum(np.searchsorted(
+                    sorted_x, xs[targets] + MIN_SIBLING_DISTANCE,
+                    side="right"), last)
+                force[targets] += (
+                    cls._near_field(xs, order, targets, first, close_first) +
+                    cls._near_field(xs, order, targets, close_last, last))
+                break
+
+            scale *= 2
+            sorted_cell = np.minimum((sorted_position * scale).astype(
+                np.int64), num * scale - 1)
+            cell[order] = sorted_cell
+            force[targets] += cls._far_cells(cell[targets], sorted_cell,
+                                             near_cells, width / scale)
+        return force
+
+    @staticmethod
+    def _far_cells(target_cell, sorted_cell, near_cells, width):
+        """Return the far field at the centre of each target cell from the
+        cells of the given width that were near cells of its parent, twice
+        as wide, but are not near cells of its own.  sorted_cell holds the
+        cell of every node, in ascending order.
+        """
+        cells, inverse = np.unique(target_cell, return_inverse=True)
+        starts = np.flatnonzero(np.diff(sorted_cell, prepend=-1))
+        occupied = sorted_cell[starts]
+        counts = np.diff(np.append(starts, len(sorted_cell)))
+
+        k = near_cells
+        even = np.concatenate([np.arange(-2 * k, -k),
+                               np.arange(k + 1, 2 * k + 2)])
+        odd = np.concatenate([np.arange(-2 * k - 1, -k),
+                              np.arange(k + 1, 2 * k + 1)])
+        offsets = np.where((cells % 2 == 0)[:, np.newaxis], even, odd)
+        sources = cells[:, np.newaxis] + offsets
+        index = np.minimum(np.searchsorted(occupied, sources),
+                           len(occupied) - 1)
+        weight = np.where(occupied[index] == sources, counts[index], 0)
+        return (weight / (offsets * width)).sum(axis=1)[inverse]
+
+    @staticmethod
+    def _near_field(xs, order, owners, first, last):
+        """Return, for every node in owners, the exact sum of 1/(sib - x)
+        over the siblings order[first:last] at the same position in first
+        and last, a chunk of at most MAX_PAIRS_PER_CHUNK pairs at a time
+        """
+        force = np.zeros(len(owners))
+        lengths = last - first
+        ends = np.cumsum(lengths)
+        node = 0
+        while node < len(owners):
+            stop = max(np.searchsorted(ends, ends[node] - lengths[node] +
+                                       MAX_PAIRS_PER_CHUNK, side="right"),
+                       node + 1)
+            chunk_lengths = lengths[node:stop]
+            owner = np.repeat(np.arange(node, stop), chunk_lengths)
+            within = np.arange(chunk_lengths.sum()) - np.repeat(
+                np.cumsum(chunk_lengths) - chunk_lengths, chunk_lengths)
+            partner = order[np.repeat(first[node:stop], chunk_lengths) +
+                            within]
+            dist = xs[partner] - xs[owners[owner]]
+            inverse = np.zeros_like(dist)
+            np.divide(1.0, dist, out=inverse,
+                      where=np.abs(dist) > MIN_SIBLING_DISTANCE)
+            force[node:stop] += np.bincount(owner - node, weights=inverse,
+                                            minlength=stop - node)
+            node = stop
+        return force
+
+
+def _linked(nodes, ptr, idx):
+    """Return the flattened indices linked to nodes in compressed sparse row
+    form, with the position in nodes each belongs to and the number of links
+    of each node
+    """
+    starts = ptr[nodes]
+    counts = ptr[nodes + 1] - starts
+    owner = np.repeat(np.arange(len(nodes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    return idx[np.repeat(starts, counts) + offsets], owner, counts
+
+
+def _inversions(values):
+    """Return the number of pairs i < j with values[i] > values[j] for an
+    array of non-negative integers.  This is a bottom-up merge sort that
+    merges every pair of runs at once: each value of a right run is looked up
+    in its left run, and the key block * scale + value keeps runs apart.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    num = len(values)
+    if num < 2:
+        return 0
+    scale = int(values.max()) + 1
+    index = np.arange(num)
+    total = 0
+    width = 1
+    while width < num:
+        block = index // (2 * width)
+        right = (index // width) % 2 == 1
+        keys = block * scale + values
+        left_keys = keys[~right]
+        ends = np.searchsorted(left_keys, (block[right] + 1) * scale)
+        total += int((ends - np.searchsorted(left_keys, keys[right],
+                                             side="right")).sum())
+        values = np.sort(keys, kind="stable") - block * scale
+        width *= 2
+    return total
+
+
+def count_crossings(levels, xs, parent_ptr, parent_idx):
+    """Return the number of pairs of edges that cross, where edges are
+    compared when they join the same two levels.  Within such a group, two
+    edges cross when their ends on one level are in the opposite order to
+    their ends on the other.  Edges sharing an end never cross.  This is an
+    inversion count, O(E log^2 E) for E edges.
+    """
+    levels = np.asarray(levels, dtype=np.int64)
+    xs = np.asarray(xs, dtype=float)
+    parent_ptr = np.asarray(parent_ptr, dtype=np.intp)
+    child = np.repeat(np.arange(len(levels)), np.diff(parent_ptr))
+    parent = np.asarray(parent_idx, dtype=np.intp)
+    if len(child) < 2:
+        return 0
+
+    group = levels[child] * (int(levels.max()) + 1) + levels[parent]
+    _unique, child_rank = np.unique(xs[child], return_inverse=True)
+    order = np.lexsort((xs[child], xs[parent], group))
+    return _inversions(group[order] * (int(child_rank.max()) + 1) +
+                       child_rank[order])
+
+
+def layered_positions(levels, parent_ptr, parent_idx, child_ptr, child_idx,
+                      x0, width, method="barycentric", sweeps=4):
+    """Order the nodes on every level below the top to reduce edge
+    crossings, in the manner of Sugiyama, and return (x, crossings): x
+    positions spreading each level evenly over width, centred below level 0,
+    in that order, and the number of crossings they have.
+
+    Going down the levels, every level is sorted by the mean, or the median
+    if method is "median", of the positions of the parents of its nodes.
+    Each of up to sweeps further sweeps first goes back up sorting by the
+    positions of children, then down again, and sweeping stops once it no
+    longer removes crossings as counted by count_crossings.  Ties keep the
+    order of x0, and level 0 keeps its positions.
+    """
+    levels = np.asarray(levels, dtype=np.intp)
+    parent_ptr = np.asarray(parent_ptr, dtype=np.intp)
+    parent_idx = np.asarray(parent_idx, dtype=np.intp)
+    child_ptr = np.asarray(child_ptr, dtype=np.intp)
+    child_idx = np.asarray(child_idx, dtype=np.intp)
+    x = np.array(x0, dtype=float)
+    depth = int(levels.max()) + 1 if len(levels) else 0
+
+    order = np.argsort(levels, kind="stable")
+    bounds = np.searchsorted(levels[order], np.arange(depth + 1))
+    level_nodes = [order[bounds[i]:bounds[i + 1]] for i in range(depth)]
+    left = x[level_nodes[0]].mean() - width / 2 if depth else 0.0
+
+    def place(nodes, ptr, idx):
+        flat, owner, counts = _linked(nodes, ptr, idx)
+        key = x[nodes].copy()
+        linked = counts > 0
+        if method == "median":
+            # Links sorted by owner and then position, so the links of each
+            # node are contiguous and in order
+            values = x[flat][np.lexsort((x[flat], owner))]
+            first = np.cumsum(counts) - counts
+            low = values[(first + (counts - 1) // 2)[linked]]
+            high = values[(first + counts // 2)[linked]]
+            key[linked] = (low + high) / 2
+        else:
+            sums = np.bincount(owner, weights=x[flat], minlength=len(nodes))
+            key[linked] = sums[linked] / counts[linked]
+        ranked = nodes[np.lexsort((x[nodes], key))]
+        x[ranked] = left + (np.arange(len(nodes)) + 0.5) * width / len(nodes)
+
+    def sweep_down():
+        for level in range(1, depth):
+            place(level_nodes[level], parent_ptr, parent_idx)
+
+    sweep_down()
+    best = count_crossings(levels, x, parent_ptr, parent_idx)
+    for sweep in range(sweeps):
+        previous = x.copy()
+        for level in range(depth - 2, 0, -1):
+            place(level_nodes[level], child_ptr, child_idx)
+        sweep_down()
+        found = count_crossings(levels, x, parent_ptr, parent_idx)
+        logger.debug("Ordering sweep {} of {}: {} crossings".format(
+            sweep + 1, sweeps, found))
+        if found >= best:
+            x = previous
+            break
+        best = found
+    return x, best
+
+
+def start_positions(levels, parent_ptr, parent_idx, child_ptr, child_idx,
+                    config):
+    """Return starting x positions for a layout from scratch, and the
+    number of edge crossings of their ordering, or None if they are random.
+    Level 0 nodes are spaced top_level_spacing apart in index order and the
+    others are put at random across the width of level 0 plus one spacing.
+    Unless the initializer config option is "random", levels are then
+    ordered by layered_positions.
+    """
+    levels = np.asarray(levels, dtype=np.intp)
+    number_top_level = int((levels == 0).sum())
+    width = (number_top_level + 1) * config["top_level_spacing"]
+
+    x0 = np.empty(len(levels))
+    count_top_level = 0
+    for i, level in enumerate(levels):
+        if level == 0:
+            x0[i] = float(count_top_level) * config["top_level_spacing"]
+            count_top_level += 1
+        else:
+            x0[i] = width * random.random()
+
+    initializer = config["initializer"]
+    if initializer == "random":
+        return x0, None
+    x0, crossings = layered_positions(levels, parent_ptr, parent_idx,
+                                      child_ptr, child_idx, x0, width,
+                                      initializer, config["ordering_sweeps"])
+    logger.info("Starting from a {} ordering with {} edge crossings".format(
+        initializer, crossings))
+    return x0, crossings
+
+
+def solve_layout(levels, parent_ptr, parent_idx, child_ptr, child_idx,
+                 config):
+    """Lay out a graph from scratch with a LayoutEngine, starting from
+    start_positions.  Returns the arrays of x and y positions and a
+    dictionary of statistics of the run.
+    """
+    x0, crossings = start_positions(levels, parent_ptr, parent_idx,
+                                    child_ptr, child_idx, config)
+    solver = LayoutEngine(levels, parent_ptr, parent_idx, config)
+    xs, ys = solver.run(x0)
+    stats = {"layout_iterations": solver.iterations}
+    if crossings is not None:
+        stats["initial_crossings"] = crossings
+    return xs, ys, stats
+
+
+def score_layout(levels, xs, parent_ptr, parent_idx, score="crossings"):
+    """Return how untidy a layout is by the measure score, one of
+    TRIAL_SCORES: the number of edge crossings, as counted by
+    count_crossings, or the total horizontal length of the edges
+    """
+    if score == "crossings":
+        return count_crossings(levels, xs, parent_ptr, parent_idx)
+    xs = np.asarray(xs, dtype=float)
+    child = np.repeat(np.arange(len(xs)), np.diff(np.asarray(parent_ptr)))
+    parent = np.asarray(parent_idx, dtype=np.intp)
+    return float(np.abs(xs[child] - xs[parent]).sum())
+
+
+#: The (graph, config) laid out by a search_layouts worker process
+_trial = None
+
+
+def _init_trial_worker(graph, config):
+    global _trial
+    _trial = (graph, config)
+    # Every trial would log the same progress messages
+    logger.setLevel(logging.WARNING)
+
+
+def _run_trial(seed, score):
+    graph, config = _trial
+    random.seed(seed)
+    xs, ys, stats = solve_layout(*graph, config=config)
+    levels, parent_ptr, parent_idx = graph[:3]
+    return score_layout(levels, xs, parent_ptr, parent_idx, score), xs, ys, \
+        stats
+
+
+def search_layouts(levels, parent_ptr, parent_idx, child_ptr, child_idx,
+                   config, seeds, score="crossings", workers=None):
+    """Run solve_layout once per seed, seeding random numbers with it, on
+    up to workers processes, and return (seed, score, xs, ys, stats) for
+    the layout with the lowest score, the earliest seed winning ties, and
+    the list of (seed, score) of every trial.  The graph is handed to each
+    worker once, as flat arrays, when the worker starts, so only seeds and
+    positions travel per trial.  A trial gives the same layout as
+    solve_layout run after seeding random numbers with its seed.
+    """
+    graph = (array("l", levels), array("l", parent_ptr),
+             array("l", parent_idx), array("l", child_ptr),
+             array("l", child_idx))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_trial_worker,
+            initargs=(graph, config)) as pool:
+        results = list(pool.map(_run_trial, seeds,
+                                [score] * len(seeds)))
+
+    scores = [(seed, result[0]) for seed, result in zip(seeds, results)]
+    best = min(range(len(seeds)), key=lambda i: results[i][0])
+    return (seeds[best],) + results[best], scores
@@ -0,0 +1,158 @@
+"""Timing and memory measurements of the phases of a run"""
+
+import contextlib
+import cProfile
+import json
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+#: Identifies files written by Metrics.write
+METRICS_FORMAT_VERSION = 2
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process so far in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak / 1e6
+    return peak / 1e3
+
+
+def _reset_peak_rss():
+    """Lower the peak resident set size of this process to its current size,
+    which only Linux supports, and return whether that worked
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def _status_mb(field):
+    """Return a size in MB from /proc/self/status, or None if there is no
+    such field
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1e3
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def _children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Metrics(object):
+    """Records the wall time, CPU time and peak RSS of every phase of a
+    run, along with statistics added by the phases themselves.  The phase
+    named profile_phase is run under cProfile if profile_file is set, and
+    the profile is dumped there.
+
+    On Linux the peak RSS of the process is reset at the start of every
+    phase, so each phase gets its own peak, and the peak of the whole run
+    is kept here instead.  Elsewhere a phase only has its own peak of the
+    memory traced by tracemalloc, if it was started, for example with
+    python -X tracemalloc.  Phases running at the same time in several
+    threads share one peak.
+    """
+
+    def __init__(self, profile_file=None, profile_phase="layout"):
+        self.profile_file = profile_file
+        self.profile_phase = profile_phase
+        self.phases = []
+        self.stats = {}
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._children_cpu = _children_cpu_seconds()
+        self._peak_rss = peak_rss_mb()
+
+    def _update_peak_rss(self):
+        """Return the peak RSS of the run so far, before it is reset"""
+        self._peak_rss = max(self._peak_rss, peak_rss_mb())
+        return self._peak_rss
+
+    @contextlib.contextmanager
+    def phase(self, name, **details):
+        """Measure the body of a with statement as one phase.  details are
+        stored with the measurements, for example the output file a render
+        phase writes.
+        """
+        profiler = None
+        if self.profile_file is not None and name == self.profile_phase:
+            profiler = cProfile.Profile()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children_cpu = _children_cpu_seconds()
+        self._update_peak_rss()
+        own_peak = _reset_peak_rss()
+        traced = (not own_peak and tracemalloc.is_tracing() and
+                  hasattr(tracemalloc, "reset_peak"))
+        if traced:
+            tracemalloc.reset_peak()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record = dict(details, name=name,
+                          wall_seconds=time.perf_counter() - wall,
+                          cpu_seconds=time.process_time() - cpu,
+                          children_cpu_seconds=(_children_cpu_seconds() -
+                                                children_cpu),
+                          peak_rss_mb=(_status_mb("VmHWM") if own_peak
+                                       else None),
+                          peak_rss_mb_so_far=self._update_peak_rss())
+            if traced:
+                _current, traced_peak = tracemalloc.get_traced_memory()
+                record["peak_traced_mb"] = traced_peak / 1e6
+            self.phases.append(record)
+            peak = record["peak_rss_mb"]
+            logger.debug("Phase {} took {:.3f}s, {:.3f}s CPU, peak RSS "
+                         "{} MB, {:.1f} MB for the run so far".format(
+                             name, record["wall_seconds"],
+                             record["cpu_seconds"],
+                             "?" if peak is None else "{:.1f}".format(peak),
+                             record["peak_rss_mb_so_far"]))
+            if profiler is not None:
+                profiler.dump_stats(self.profile_file)
+                logger.info("Wrote profile of the {} phase to {}, read it "
+                            "with python -m pstats".format(name,
+                                                           self.profile_file))
+
+    def to_dict(self):
+        """Return every measurement so far, with totals for the whole run"""
+        return {
+            "version": METRICS_FORMAT_VERSION,
+            "command": sys.argv,
+            "phases": self.phases,
+            "stats": self.stats,
+            "total": {
+                "wall_seconds": time.perf_counter() - self._wall,
+                "cpu_seconds": time.process_time() - self._cpu,
+                "children_cpu_seconds": (_children_cpu_seconds() -
+                                         self._children_cpu),
+                "peak_rss_mb": self._update_peak_rss(),
+            },
+        }
+
+    def write(self, filename):
+        """Save the measurements as JSON"""
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            f.write("\n")
+        logger.info("Wrote metrics: {}".format(filename))
@@ -0,0 +1,131 @@
+"""Read dependency graphs straight from the local Nix store database"""
+
+import collections
+import logging
+import os
+import sqlite3
+from urllib.parse import quote
+
+from . import util
+from .cache import STORE_DIR, store_path_name
+from .graph_objects import Node, Edge
+
+logger = logging.getLogger(__name__)
+
+#: Location of the database of the local Nix store
+DEFAULT_DB = os.path.join(os.environ.get("NIX_STATE_DIR", "/nix/var/nix"),
+                          "db", "db.sqlite")
+
+#: Every path in the closure of a set of roots along with its references,
+#: leaving out the references of paths to themselves
+CLOSURE_QUERY = """
+WITH RECURSIVE closure(id) AS (
+    SELECT id FROM ValidPaths WHERE path IN ({roots})
+    UNION
+    SELECT Refs.reference FROM Refs JOIN closure ON Refs.referrer = closure.id
+)
+SELECT referrer.path, reference.path
+FROM closure
+JOIN ValidPaths AS referrer ON referrer.id = closure.id
+LEFT JOIN Refs ON Refs.referrer = closure.id AND Refs.reference != closure.id
+LEFT JOIN ValidPaths AS reference ON reference.id = Refs.reference
+"""
+
+
+class NixDatabase(object):
+    """Graph source reading the ValidPaths and Refs tables of a Nix store
+    database, which is opened read-only.  The closure of all requested roots
+    is computed by one recursive query instead of one nix-store process per
+    root.  Roots that are not in the database, or all roots if the query
+    fails, are handed to the fallback source if there is one, and reported
+    as errors otherwise.
+    """
+
+    def __init__(self, filename=DEFAULT_DB, fallback=None):
+        self.filename = filename
+        self.fallback = fallback
+        self.db = sqlite3.connect("file:{}?mode=ro".format(quote(filename)),
+                                  uri=True, check_same_thread=False)
+        # Fail now rather than on the first query if this is not readable
+        self.db.execute("SELECT id, path FROM ValidPaths LIMIT 1").fetchall()
+        self.db.execute("SELECT referrer, reference FROM Refs LIMIT 1")
+
+    def query_closures(self, packages):
+        """Yield (rank, package, closure, error) tuples like
+        nixstore.query_closures.  The closure of each package holds the
+        paths that are not in the closure of any package before it.
+        """
+
+        names = [store_path_name(p) for p in packages]
+        roots = sorted(set(os.path.join(STORE_DIR, name)
+                           for name in names if name is not None))
+        rows = []
+        try:
+            if roots:
+                query = CLOSURE_QUERY.format(roots=", ".join("?" *
+                                                             len(roots)))
+                rows = self.db.execute(query, roots).fetchall()
+        except sqlite3.Error as e:
+            logger.warning("Cannot query Nix database {}: {}".format(
+                self.filename, e))
+            for result in self._query_elsewhere(
+                    list(enumerate(packages)),
+                    util.TreeCLIError("Cannot query Nix database {}: "
+                                      "{}".format(self.filename, e))):
+                yield result
+            return
+
+        references = collections.defaultdict(list)
+        for referrer, reference in rows:
+            refs = references[os.path.basename(referrer)]
+            if reference is not None:
+                refs.append(os.path.basename(reference))
+
+        # Hand out each path to the first root that reaches it
+        seen = set()
+        missing = []
+        for rank, (package, name) in enumerate(zip(packages, names)):
+            if name not in references:
+                missing.append((rank, package))
+                continue
+
+            nodes = []
+            edges = []
+            stack = [name] if name not in seen else []
+            seen.update(stack)
+            while stack:
+                referrer = stack.pop()
+                nodes.append(Node(referrer))
+                for reference in references[referrer]:
+                    edges.append(Edge(reference, referrer))
+                    if reference not in seen:
+                        seen.add(reference)
+                        stack.append(reference)
+            yield rank, package, (nodes, edges), None
+
+        if missing:
+            for result in self._query_elsewhere(missing):
+                yield result
+
+    def _query_elsewhere(self, missing, error=None):
+        """Query the closures of the (rank, package) pairs in missing from
+        the fallback source, or yield an error for each of them if there is
+        none
+        """
+
+        if self.fallback is None:
+            for rank, package in missing:
+                yield rank, package, None, error or util.TreeCLIError(
+                    "{} is not a valid path in {}".format(package,
+                                                          self.filename))
+            return
+
+        logger.info("Querying {} packages with {} instead of {}".format(
+            len(missing), type(self.fallback).__name__, self.filename))
+        ranks = [rank for rank, _package in missing]
+        for rank, package, closure, error in self.fallback.query_closures(
+                [package for _rank, package in missing]):
+            yield ranks[rank], package, closure, error
+
+    def close(self):
+        self.db.close()
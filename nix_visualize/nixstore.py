@@ -0,0 +1,216 @@
+"""Streaming readers for the output of nix-store queries"""
+
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+from concurrent import futures
+
+from . import util
+from .cache import store_path_name
+from .graph_objects import Node, Edge
+
+#: A node or edge statement of the DOT dialect written by nix-store --graph,
+#: e.g. "<hash>-foo" [label = "foo", ...]; or "<hash>-foo" -> "<hash>-bar" [...];
+DOT_STATEMENT = re.compile(r'^\s*("(?:[^"\\]|\\.)*"|[\w.+-]+)'
+                           r'(?:\s*->\s*("(?:[^"\\]|\\.)*"|[\w.+-]+))?'
+                           r'\s*(?:\[.*\])?\s*;?\s*$')
+
+
+def _unquote(token):
+    if token.startswith('"'):
+        return token[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    return token
+
+
+def _decode(line):
+    if isinstance(line, bytes):
+        return line.decode("utf-8")
+    return line
+
+
+def parse_graph(lines):
+    """Parse the restricted DOT dialect emitted by nix-store -q --graph,
+    yielding a Node the first time each package is mentioned and an Edge for
+    every dependency statement, as soon as the line holding it is read.
+    """
+
+    seen = set()
+    for lineno, line in enumerate(lines, 1):
+        line = _decode(line).strip()
+        if (not line or line.startswith("digraph") or line == "}" or
+                line.startswith("//")):
+            continue
+
+        match = DOT_STATEMENT.match(line)
+        if match is None:
+            raise util.TreeCLIError("Cannot parse line {} of nix-store graph "
+                                    "output: {}".format(lineno, line))
+
+        names = [_unquote(t) for t in match.groups() if t is not None]
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                yield Node(name)
+        if len(names) == 2:
+            yield Edge(names[0], names[1])
+
+
+def parse_paths(lines, referrer=None):
+    """Parse one store path per line, as printed by nix-store -q --references
+    or --requisites.  Yields a Node for every path and, if the referrer the
+    paths were queried for is given, an Edge from each path to it.
+    """
+
+    seen = set()
+    if referrer is not None:
+        referrer = os.path.basename(referrer)
+        seen.add(referrer)
+        yield Node(referrer)
+
+    for line in lines:
+        path = _decode(line).strip()
+        if not path:
+            continue
+        name = os.path.basename(path)
+        if name not in seen:
+            seen.add(name)
+            yield Node(name)
+        if referrer is not None and name != referrer:
+            yield Edge(name, referrer)
+
+
+def parse_output(lines, referrer=None):
+    """Parse nix-store output in either format, detected from the first
+    non-blank line
+    """
+
+    lines = iter(lines)
+    for first in lines:
+        if _decode(first).strip():
+            break
+    else:
+        return iter(())
+
+    def _all_lines():
+        yield first
+        for line in lines:
+            yield line
+
+    if _decode(first).lstrip().startswith("digraph"):
+        return parse_graph(_all_lines())
+    return parse_paths(_all_lines(), referrer)
+
+
+def query_graph(package):
+    """Run nix-store -q --graph on a package and yield its Nodes and Edges
+    while the subprocess is still writing them
+    """
+
+    cmd = "nix-store -q --graph {}".format(package)
+    # stderr goes to a file, as a pipe that is only read once stdout ends
+    # would fill up and block nix-store if it wrote many warnings
+    with tempfile.TemporaryFile() as errors:
+        res = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                               stderr=errors)
+        try:
+            for record in parse_graph(res.stdout):
+                yield record
+        finally:
+            res.stdout.close()
+            res.wait()
+
+        if res.returncode != 0:
+            errors.seek(0)
+            message = _decode(errors.read()).strip()
+            raise util.TreeCLIError("nix-store call failed, message "
+                                    "{}".format(message))
+
+
+def _collect(records):
+    nodes = []
+    edges = []
+    for record in records:
+        if isinstance(record, Edge):
+            edges.append(record)
+        else:
+            nodes.append(record)
+    return nodes, edges
+
+
+def query_closure(package):
+    """Return the lists of Nodes and Edges in a package's closure"""
+    return _collect(query_graph(package))
+
+
+def query_closures(packages, jobs=1, cache=None):
+    """Query the closures of many packages concurrently on a pool of at most
+    jobs threads.  Yields (rank, package, closure, error) tuples in the order
+    the queries complete, where rank is the position of the package in
+    packages, closure is the (nodes, edges) pair returned by query_closure and
+    error is the TreeCLIError raised if the query failed.
+
+    If a ClosureCache is given, closures of store paths are read from it
+    when possible, and closures that had to be queried are added to it.
+    """
+
+    with futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        pending = {}
+        for rank, package in enumerate(packages):
+            name = store_path_name(package) if cache is not None else None
+            closure = cache.get(name) if name is not None else None
+            if closure is not None:
+                yield rank, package, closure, None
+            else:
+                future = pool.submit(query_closure, package)
+                pending[future] = (rank, package, name)
+
+        for future in futures.as_completed(pending):
+            rank, package, name = pending.pop(future)
+            try:
+                closure = future.result()
+            except util.TreeCLIError as e:
+                yield rank, package, None, e
+                continue
+            if name is not None:
+                cache.put(*closure)
+            yield rank, package, closure, None
+
+
+class NixStoreSource(object):
+    """Graph source that runs nix-store -q --graph for every package, up to
+    jobs at a time, going through a ClosureCache if one is given
+    """
+
+    def __init__(self, jobs=1, cache=None):
+        self.jobs = jobs
+        self.cache = cache
+
+    def query_closures(self, packages):
+        return query_closures(packages, self.jobs, self.cache)
+
+
+class DotFileSource(object):
+    """Graph source reading saved nix-store -q --graph output instead of
+    running nix-store, for use without Nix.  The closure of a package is read
+    from the file named after its store path name, <name>.dot, in directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def query_closures(self, packages):
+        for rank, package in enumerate(packages):
+            name = os.path.basename(package.rstrip("/"))
+            filename = os.path.join(self.directory, name + ".dot")
+            try:
+                with open(filename, "rb") as f:
+                    closure = _collect(parse_graph(f))
+            except OSError as e:
+                yield rank, package, None, util.TreeCLIError(
+                    "Cannot read graph of {}: {}".format(package, e))
+            except util.TreeCLIError as e:
+                yield rank, package, None, e
+            else:
+                yield rank, package, closure, None
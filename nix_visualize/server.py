@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+"""Long running service that renders dependency graphs over HTTP, on a TCP
+port or a Unix socket.
+
+    GET /graph?path=<store path>[&path=...][&format=png][&section=<name>]
+
+returns the graph of the given store paths in any output format the command
+line tool supports, laid out and drawn by a pool of worker processes.
+GET /status returns what the service holds in memory.
+
+The references of every store path seen are kept in one shared store, so
+overlapping closures are queried and held once, and rendered graphs are kept
+in an artifact cache.  Store paths never change, so graphs of store paths
+are served with an ETag and long lived Cache-Control headers.  Both the
+store and the artifact cache have size limits, beyond which the least
+recently requested graphs are evicted.
+"""
+
+import argparse
+import collections
+import configparser
+import http.server
+import json
+import logging
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import urllib.parse
+from concurrent import futures
+
+from . import nixstore, util
+from .cache import DEFAULT_MAX_PATHS, default_cache_dir, store_path_name
+from .graph_objects import Node, Edge
+from .layout import content_hash
+from .nixdb import DEFAULT_DB
+from .visualize_tree import GRAPH_SOURCES, _open_source, init_logger
+
+logger = logging.getLogger(__name__)
+
+#: Default upper bound on the total size of the rendered graphs kept
+DEFAULT_MAX_CACHE_MB = 256
+
+#: The output formats served, and their content types
+CONTENT_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+    "jpg": "image/jpeg",
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+}
+
+#: Sent with graphs of store paths, which can never change
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class StaticSource(object):
+    """Graph source handing out closures that are already known, given as
+    a dictionary from package to lists of path names and of
+    (reference, referrer) pairs
+    """
+
+    def __init__(self, closures):
+        self.closures = closures
+
+    def query_closures(self, packages):
+        for rank, package in enumerate(packages):
+            names, references = self.closures[package]
+            yield rank, package, ([Node(n) for n in names],
+                                  [Edge(r, n) for r, n in references]), None
+
+
+def render(packages, closures, config, fmt, key, layout_memo_dir=None):
+    """Lay out and draw a graph in a worker process, returning the contents
+    of the output file.  The layout is seeded from the request key, and
+    matplotlib is kept from writing dates and random ids into SVG and PDF
+    files, so the same key always gives the same bytes.
+    """
+    import matplotlib
+    from .visualize_tree import Graph
+
+    # Worker processes only ever render, so their environment is ours
+    os.environ["SOURCE_DATE_EPOCH"] = "0"
+    with tempfile.TemporaryDirectory() as workdir, \
+            matplotlib.rc_context({"svg.hashsalt": key}):
+        filename = os.path.join(workdir, "graph." + fmt)
+        Graph(packages, config, filename, source=StaticSource(closures),
+              layout_memo_dir=layout_memo_dir, seed=int(key[:8], 16))
+        with open(filename, "rb") as f:
+            return f.read()
+
+
+def config_contents(configfile, section=None):
+    """Return what a graph drawn with a section of a config file depends
+    on: the options of the section, or the whole file if the section cannot
+    be picked out, so that the response to a request changes with them
+    """
+
+    if configfile is None:
+        return None
+    configs = configparser.ConfigParser()
+    try:
+        configs.read(configfile)
+    except configparser.Error:
+        with open(configfile, "rb") as f:
+            return content_hash(f.read().decode("utf-8", "replace"))
+    if section is None and len(configs.sections()) == 1:
+        section = configs.sections()[0]
+    if section not in configs.sections():
+        return {name: dict(configs.items(name)) for name in configs.sections()}
+    return dict(configs.items(section))
+
+
+class GraphStore(object):
+    """The references of every store path the service has seen, shared by
+    all requests.  Each path is stored once, however many closures hold
+    it.  Once more than max_paths paths are stored, the closures of the
+    least recently requested roots are dropped, along with every path no
+    remaining root reaches.
+    """
+
+    def __init__(self, source, max_paths=DEFAULT_MAX_PATHS):
+        self.source = source
+        self.max_paths = max_paths
+        self.references = {}
+        self.roots = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def closures(self, packages):
+        """Return {package: (names, references)} for the closure of every
+        package, querying the source only for those not stored yet
+        """
+
+        closures = {}
+        missing = []
+        with self.lock:
+            for package in packages:
+                name = store_path_name(package)
+                if name in self.roots:
+                    self.roots.move_to_end(name)
+                    closures[package] = self._closure(name)
+                else:
+                    missing.append(package)
+
+        failed = []
+        for _rank, package, closure, error in self.source.query_closures(
+                missing):
+            if error is not None:
+                logger.error("Querying {} failed: {}".format(package, error))
+                failed.append(package)
+                continue
+            nodes, edges = closure
+            name = store_path_name(package)
+            with self.lock:
+                self._add(nodes, edges, name)
+                if name is not None and name in self.references:
+                    closures[package] = self._closure(name)
+                else:
+                    # Not a store path, so it may change and is not kept
+                    closures[package] = (
+                        [n.raw_name for n in nodes],
+                        [(e.nfrom, e.nto) for e in edges])
+        if failed:
+            raise util.TreeCLIError("Could not query {} of {} packages: "
+                                    "{}".format(len(failed), len(packages),
+                                                ", ".join(failed)))
+
+        with self.lock:
+            self._evict()
+        return closures
+
+    def _add(self, nodes, edges, root):
+        references = {n.raw_name: [] for n in nodes}
+        for e in edges:
+            references.setdefault(e.nto, []).append(e.nfrom)
+        for name, refs in references.items():
+            # Store paths are immutable, so what is stored already is right
+            if name not in self.references:
+                self.references[name] = tuple(refs)
+        if root is not None and root in self.references:
+            self.roots[root] = True
+
+    def _closure(self, root):
+        names = []
+        references = []
+        seen = {root}
+        stack = [root]
+        while stack:
+            name = stack.pop()
+            names.append(name)
+            for reference in self.references[name]:
+                references.append((reference, name))
+                if reference not in seen:
+                    seen.add(reference)
+                    stack.append(reference)
+        return names, references
+
+    def _evict(self):
+        if len(self.references) <= self.max_paths:
+            return
+        while len(self.roots) > 1 and len(self.references) > self.max_paths:
+            root, _ = self.roots.popitem(last=False)
+            live = set()
+            for name in self.roots:
+                live.update(self._closure(name)[0])
+            dropped = len(self.references) - len(live)
+            self.references = {name: refs for name, refs in
+                               self.references.items() if name in live}
+            logger.info("Evicted the closure of {}, dropping {} paths".format(
+                root, dropped))
+
+    def status(self):
+        with self.lock:
+            return {"paths": len(self.references), "roots": len(self.roots),
+                    "max_paths": self.max_paths}
+
+
+class ArtifactCache(object):
+    """Rendered graphs by request key, dropping the least recently used once
+    they take more than max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.artifacts = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.artifacts.get(key)
+            if body is not None:
+                self.artifacts.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key not in self.artifacts:
+                self.artifacts[key] = body
+                self.size += len(body)
+            while self.size > self.max_bytes:
+                _key, old = self.artifacts.popitem(last=False)
+                self.size -= len(old)
+
+    def status(self):
+        with self.lock:
+            return {"artifacts": len(self.artifacts), "bytes": self.size,
+                    "max_bytes": self.max_bytes}
+
+
+class VisualizationService(object):
+    """Answers graph requests from the shared GraphStore and ArtifactCache,
+    running at most workers layouts at once in a process pool.  Identical
+    requests that arrive together share one render.
+    """
+
+    def __init__(self, source, configfile=None, workers=1,
+                 max_paths=DEFAULT_MAX_PATHS,
+                 max_cache_bytes=DEFAULT_MAX_CACHE_MB * 1000000,
+                 layout_memo_dir=None):
+        self.store = GraphStore(source, max_paths)
+        self.artifacts = ArtifactCache(max_cache_bytes)
+        self.configfile = configfile
+        self.layout_memo_dir = layout_memo_dir
+        self.pool = futures.ProcessPoolExecutor(max_workers=max(workers, 1))
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hits = 0
+
+    def key(self, packages, fmt="png", section=None):
+        """Return (key, etag, cacheable) for the graph of packages drawn in
+        format fmt with the given config file section.  cacheable is False
+        if any package is not a store path, as its closure may change.  They
+        depend only on the request and the config, so a conditional request
+        can be answered without drawing the graph.
+        """
+
+        if fmt not in CONTENT_TYPES:
+            raise util.TreeCLIError("Unknown format {}, choose one of "
+                                    "{}".format(fmt, ", ".join(CONTENT_TYPES)))
+        paths = [os.path.realpath(p) for p in packages]
+        cacheable = all(store_path_name(p) is not None for p in paths)
+        config = (self.configfile, section)
+        # Responses are cached for good, so a change to the config must
+        # change their key
+        key = content_hash({"packages": paths, "format": fmt,
+                            "config": config,
+                            "options": config_contents(*config)})
+        return key, '"{}"'.format(key[:32]), cacheable
+
+    def graph(self, packages, fmt="png", section=None):
+        """Return (etag, cacheable, body) for the graph of packages, as
+        described by key
+        """
+
+        key, etag, cacheable = self.key(packages, fmt, section)
+        config = (self.configfile, section)
+
+        with self.lock:
+            self.requests += 1
+        body = self.artifacts.get(key) if cacheable else None
+        if body is not None:
+            with self.lock:
+                self.hits += 1
+            return etag, cacheable, body
+
+        with self.lock:
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = futures.Future()
+                self.pending[key] = future
+
+        if not owner:
+            return etag, cacheable, future.result()
+
+        try:
+            closures = self.store.closures(packages)
+            body = self.pool.submit(render, packages, closures, config, fmt,
+                                    key, self.layout_memo_dir).result()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(body)
+            if cacheable:
+                self.artifacts.put(key, body)
+        finally:
+            with self.lock:
+                del self.pending[key]
+        return etag, cacheable, body
+
+    def status(self):
+        with self.lock:
+            requests = {"requests": self.requests, "cache_hits": self.hits,
+                        "in_progress": len(self.pending)}
+        return {"store": self.store.status(),
+                "artifacts": self.artifacts.status(), "requests": requests}
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /graph and /status from the server's VisualizationService"""
+
+    server_version = "nix-visualize"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/status":
+            body = json.dumps(self.server.service.status()).encode("utf-8")
+            self._send(200, "application/json", body,
+                       {"Cache-Control": "no-store"})
+        elif url.path == "/graph":
+            self._graph(query)
+        else:
+            self._send_error(404, "No such resource {}".format(url.path))
+
+    def _graph(self, query):
+        packages = query.get("path", [])
+        if not packages:
+            self._send_error(400, "Give at least one path parameter")
+            return
+        fmt = query.get("format", ["png"])[0]
+        section = query.get("section", [None])[0]
+        service = self.server.service
+        try:
+            _key, etag, cacheable = service.key(packages, fmt, section)
+            if cacheable and etag in self.headers.get("If-None-Match", ""):
+                # The client has this graph already, however long ago it
+                # was drawn
+                self._send(304, None, b"", {"Cache-Control": IMMUTABLE,
+                                            "ETag": etag})
+                return
+            etag, cacheable, body = service.graph(packages, fmt, section)
+        except util.TreeCLIError as e:
+            self._send_error(400, str(e))
+            return
+        except Exception as e:
+            logger.exception("Rendering {} failed".format(packages))
+            self._send_error(500, "Rendering failed: {}".format(e))
+            return
+
+        headers = {"Cache-Control": IMMUTABLE if cacheable else "no-cache"}
+        if cacheable:
+            headers["ETag"] = etag
+        self._send(200, CONTENT_TYPES[fmt], body, headers)
+
+    def _send(self, code, content_type, body, headers=()):
+        self.send_response(code)
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in dict(headers).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        body = json.dumps({"error": message}).encode("utf-8")
+        self._send(code, "application/json", body,
+                   {"Cache-Control": "no-store"})
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        if not isinstance(self.client_address, tuple):
+            return "unix"
+        return super().address_string()
+
+    def log_message(self, format, *args):
+        logger.info("{} {}".format(self.address_string(), format % args))
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve graphs of Nix "
+                                     "dependencies over HTTP")
+    parser.add_argument("--listen", default="127.0.0.1:8080",
+                        help="host:port to serve on, default is "
+                        "127.0.0.1:8080")
+    parser.add_argument("--socket", help="serve on this Unix socket instead "
+                        "of a TCP port")
+    parser.add_argument("--configfile", "-c", help="ini file with layout and "
+                        "style configuration, whose sections are chosen with "
+                        "the section parameter of a request")
+    parser.add_argument("--workers", "-w", type=int,
+                        default=os.cpu_count() or 1,
+                        help="number of graphs to lay out at the same time, "
+                        "default is the number of CPUs")
+    parser.add_argument("--max-paths", type=int, default=DEFAULT_MAX_PATHS,
+                        help="maximum number of store paths to hold in "
+                        "memory, default is {}".format(DEFAULT_MAX_PATHS))
+    parser.add_argument("--max-cache-mb", type=float,
+                        default=DEFAULT_MAX_CACHE_MB,
+                        help="maximum size of the rendered graphs to hold in "
+                        "memory, default is {} MB".format(
+                            DEFAULT_MAX_CACHE_MB))
+    parser.add_argument("--graph-dir", help="read closures from <name>.dot "
+                        "files in this directory instead of from Nix")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="number of nix-store queries to run at the "
+                        "same time, default is the number of CPUs")
+    parser.add_argument("--source", choices=GRAPH_SOURCES, default="auto",
+                        help="where to read dependency graphs from, as for "
+                        "nix-visualize")
+    parser.add_argument("--nix-db", default=DEFAULT_DB,
+                        help="Nix store database to read, default is "
+                        "{}".format(DEFAULT_DB))
+    parser.add_argument("--cache-dir", help="directory holding the closure "
+                        "and layout caches, default is "
+                        "$XDG_CACHE_HOME/nix-visualize")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_PATHS,
+                        help="maximum number of store paths to keep in the "
+                        "closure cache, default is {}".format(
+                            DEFAULT_MAX_PATHS))
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="do not use the closure and layout caches")
+    parser.add_argument('--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--no-verbose', dest='verbose', action='store_false')
+    parser.set_defaults(verbose=False)
+    args = parser.parse_args()
+
+    init_logger(debug=args.verbose)
+
+    try:
+        if args.graph_dir is not None:
+            source = nixstore.DotFileSource(args.graph_dir)
+        else:
+            source = _open_source(args)
+    except util.TreeCLIError as e:
+        sys.stderr.write("ERROR: {}\n".format(e))
+        sys.exit(1)
+
+    layout_memo_dir = None
+    if args.cache:
+        layout_memo_dir = os.path.join(args.cache_dir or default_cache_dir(),
+                                       "layouts")
+    service = VisualizationService(
+        source, args.configfile, args.workers, args.max_paths,
+        int(args.max_cache_mb * 1000000), layout_memo_dir)
+
+    if args.socket is not None:
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        logger.info("Serving on {}".format(args.socket))
+    else:
+        host, _sep, port = args.listen.rpartition(":")
+        server = HTTPServer((host or "127.0.0.1", int(port)), RequestHandler)
+        logger.info("Serving on http://{}:{}".format(*server.server_address))
+    server.service = service
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""Tiled rendering of very large images as a Deep Zoom pyramid of PNG tiles
+with an HTML viewer, drawn one tile at a time so that memory use does not
+grow with the size of the canvas
+"""
+
+import html
+import io
+import logging
+import math
+import os
+
+import numpy as np
+
+from . import util
+
+logger = logging.getLogger(__name__)
+
+#: Name of the Deep Zoom descriptor, next to which the tiles are kept in
+#: the directory <name>_files
+DZI_NAME = "graph"
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="png"
+       Overlap="0" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+#: A page that pans and zooms the pyramid with no other dependencies.
+#: Tiles of coarser levels stand in while the tiles of the current level
+#: load.
+VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+html, body {{ margin: 0; height: 100%; overflow: hidden; background: #fff; }}
+canvas {{ display: block; cursor: grab; }}
+</style>
+</head>
+<body>
+<canvas id="view"></canvas>
+<script>
+"use strict";
+const WIDTH = {width}, HEIGHT = {height}, TILE = {tile_size};
+const MAX_LEVEL = {max_level}, FILES = "{files}";
+const canvas = document.getElementById("view");
+const ctx = canvas.getContext("2d");
+const tiles = new Map();
+let scale = 1, left = 0, top = 0, pending = false;
+
+function redraw() {{
+  if (!pending) {{
+    pending = true;
+    requestAnimationFrame(draw);
+  }}
+}}
+
+function tile(level, col, row) {{
+  const key = level + "/" + col + "_" + row;
+  let img = tiles.get(key);
+  if (!img) {{
+    img = new Image();
+    img.onload = redraw;
+    img.src = FILES + "/" + key + ".png";
+    tiles.set(key, img);
+  }}
+  return img;
+}}
+
+function drawLevel(level) {{
+  const factor = Math.pow(2, MAX_LEVEL - level);
+  const size = TILE * factor * scale;
+  const cols = Math.ceil(WIDTH / factor / TILE);
+  const rows = Math.ceil(HEIGHT / factor / TILE);
+  const col0 = Math.max(0, Math.floor(-left / size));
+  const col1 = Math.min(cols - 1, Math.floor((canvas.width - left) / size));
+  const row0 = Math.max(0, Math.floor(-top / size));
+  const row1 = Math.min(rows - 1, Math.floor((canvas.height - top) / size));
+  for (let row = row0; row <= row1; row++) {{
+    for (let col = col0; col <= col1; col++) {{
+      const img = tile(level, col, row);
+      if (img.complete && img.naturalWidth) {{
+        ctx.drawImage(img, left + col * size, top + row * size,
+                      img.naturalWidth * factor * scale,
+                      img.naturalHeight * factor * scale);
+      }}
+    }}
+  }}
+}}
+
+function draw() {{
+  pending = false;
+  ctx.fillStyle = "#fff";
+  ctx.fillRect(0, 0, canvas.width, canvas.height);
+  const level = Math.max(0, Math.min(MAX_LEVEL,
+                                     MAX_LEVEL + Math.ceil(Math.log2(scale))));
+  for (let coarse = Math.max(0, level - 3); coarse <= level; coarse++) {{
+    drawLevel(coarse);
+  }}
+}}
+
+function fit() {{
+  canvas.width = window.innerWidth;
+  canvas.height = window.innerHeight;
+  scale = Math.min(canvas.width / WIDTH, canvas.height / HEIGHT);
+  left = (canvas.width - WIDTH * scale) / 2;
+  top = (canvas.height - HEIGHT * scale) / 2;
+  redraw();
+}}
+
+function zoom(x, y, factor) {{
+  left = x - (x - left) * factor;
+  top = y - (y - top) * factor;
+  scale *= factor;
+  redraw();
+}}
+
+canvas.addEventListener("wheel", (e) => {{
+  e.preventDefault();
+  zoom(e.offsetX, e.offsetY, Math.exp(-e.deltaY * 0.002));
+}}, {{ passive: false }});
+canvas.addEventListener("dblclick", (e) => zoom(e.offsetX, e.offsetY, 2));
+canvas.addEventListener("pointerdown", (e) => {{
+  canvas.setPointerCapture(e.pointerId);
+  canvas.style.cursor = "grabbing";
+}});
+canvas.addEventListener("pointermove", (e) => {{
+  if (canvas.hasPointerCapture(e.pointerId)) {{
+    left += e.movementX;
+    top += e.movementY;
+    redraw();
+  }}
+}});
+canvas.addEventListener("pointerup", () => {{ canvas.style.cursor = "grab"; }});
+window.addEventListener("resize", fit);
+fit();
+</script>
+</body>
+</html>
+"""
+
+
+def _level_size(width, height, max_level, level):
+    """Return the size in pixels of the image at a level of the pyramid"""
+    factor = 2 ** (max_level - level)
+    return int(math.ceil(width / factor)), int(math.ceil(height / factor))
+
+
+def _tile_path(files, level, col, row):
+    return os.path.join(files, str(level), "{}_{}.png".format(col, row))
+
+
+class TileRenderer(object):
+    """Draws the tiles of the most detailed level of a pyramid from a scene,
+    reusing one small figure for all of them.  A tile only draws the edges
+    whose bounding boxes and the nodes whose markers or labels reach into
+    it.
+    """
+
+    def __init__(self, scene, config, width, height):
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
+
+        self.plt = plt
+        self.scene = scene
+        self.config = config
+        self.dpi = config["dpi"]
+        self.blank = {}
+
+        (self.x_low, self.x_high), (self.y_low, self.y_high) = scene["limits"]
+        self.x_per_pixel = (self.x_high - self.x_low) / width
+        self.y_per_pixel = (self.y_high - self.y_low) / height
+
+        segments = scene["segments"]
+        self.edge_low = segments.min(axis=1)
+        self.edge_high = segments.max(axis=1)
+
+        self.fig = plt.figure(figsize=(1, 1))
+        self.fig.set_facecolor("w")
+        self.ax = self.fig.add_axes((0, 0, 1, 1))
+        self.ax.set_axis_off()
+        self.edges = LineCollection(
+            [], colors=config["edge_color"], antialiaseds=(1,),
+            alpha=config["edge_alpha"], zorder=1)
+        self.ax.add_collection(self.edges)
+        self.nodes = self.ax.scatter(
+            np.zeros(0), np.zeros(0), s=np.zeros(0), c=np.zeros(0),
+            cmap=scene["cmap"], vmin=0, vmax=255, zorder=2)
+
+        points_to_pixels = self.dpi / 72.0
+        self.node_margin = (np.sqrt(scene["sizes"].max()) / 2 *
+                            points_to_pixels if len(scene["sizes"]) else 0)
+        self.edge_margin = (np.max(scene["widths"]) * points_to_pixels
+                            if scene["widths"].size else 0)
+        self.labels = scene["labels"]
+        self.font_size = 12 * config["font_scale"]
+        if self.labels is not None:
+            # Labels are centred on their nodes, so a label only reaches
+            # into a tile if its node is within half its width of it.
+            # Measuring them once costs less than drawing every one in all
+            # the tiles that the longest could reach.
+            from matplotlib.font_manager import FontProperties
+            self.fig.set_dpi(self.dpi)
+            renderer = self.fig.canvas.get_renderer()
+            font = FontProperties(size=self.font_size, weight="light")
+            half_widths = [renderer.get_text_width_height_descent(
+                label, font, ismath=False)[0] / 2 + 1
+                for label in self.labels]
+            self.label_dx = (np.array(half_widths, dtype=float) *
+                             self.x_per_pixel)
+            self.label_dy = self.font_size * points_to_pixels * \
+                self.y_per_pixel
+
+    def close(self):
+        self.plt.close(self.fig)
+
+    def _window(self, left, top, width, height, margin):
+        """Return the data limits of a rectangle of pixels, widened by a
+        margin in pixels
+        """
+        return (self.x_low + (left - margin) * self.x_per_pixel,
+                self.x_low + (left + width + margin) * self.x_per_pixel,
+                self.y_high - (top + height + margin) * self.y_per_pixel,
+                self.y_high - (top - margin) * self.y_per_pixel)
+
+    def render(self, filename, left, top, width, height):
+        """Draw the width by height pixels whose top left corner is at
+        (left, top) of the full image to filename
+        """
+        scene = self.scene
+        x0, x1, y0, y1 = self._window(left, top, width, height,
+                                      self.edge_margin)
+        edges = np.flatnonzero((self.edge_high[:, 0] >= x0) &
+                               (self.edge_low[:, 0] <= x1) &
+                               (self.edge_high[:, 1] >= y0) &
+                               (self.edge_low[:, 1] <= y1))
+        x0, x1, y0, y1 = self._window(left, top, width, height,
+                                      self.node_margin)
+        xs, ys = scene["x"], scene["y"]
+        nodes = np.flatnonzero((xs >= x0) & (xs <= x1) &
+                               (ys >= y0) & (ys <= y1))
+        labelled = []
+        if self.labels is not None:
+            x0, x1, y0, y1 = self._window(left, top, width, height, 0)
+            labelled = np.flatnonzero((xs + self.label_dx >= x0) &
+                                      (xs - self.label_dx <= x1) &
+                                      (ys + self.label_dy >= y0) &
+                                      (ys - self.label_dy <= y1))
+
+        if len(edges) == 0 and len(nodes) == 0 and len(labelled) == 0:
+            # Most tiles of a large graph are empty
+            if (width, height) not in self.blank:
+                self.blank[(width, height)] = self._draw(width, height)
+            with open(filename, "wb") as f:
+                f.write(self.blank[(width, height)])
+            return
+
+        self.edges.set_segments(scene["segments"][edges])
+        widths = scene["widths"]
+        self.edges.set_linewidths(widths[edges] if widths.ndim else widths)
+        self.nodes.set_offsets(np.column_stack([xs[nodes], ys[nodes]]))
+        self.nodes.set_sizes(scene["sizes"][nodes])
+        self.nodes.set_array(scene["colors"][nodes])
+        texts = []
+        for i in labelled:
+            texts.append(self.ax.text(
+                xs[i], ys[i], self.labels[i], size=self.font_size,
+                color=self.config["font_color"], weight="light",
+                horizontalalignment="center", verticalalignment="center",
+                clip_on=True))
+
+        x0, x1, y0, y1 = self._window(left, top, width, height, 0)
+        self.ax.set_xlim(x0, x1)
+        self.ax.set_ylim(y0, y1)
+        with open(filename, "wb") as f:
+            f.write(self._draw(width, height))
+        for text in texts:
+            text.remove()
+
+    def _draw(self, width, height):
+        self.fig.set_size_inches(width / self.dpi, height / self.dpi)
+        out = io.BytesIO()
+        self.fig.savefig(out, dpi=self.dpi, format="png")
+        return out.getvalue()
+
+
+def _downsample(files, level, col, row, next_size, tile_size):
+    """Return the tile of a level made by halving the up to four tiles of
+    the next level that it covers, of which there are fewer along the right
+    and bottom edges of the next level's next_size
+    """
+    import matplotlib.image as mpimg
+
+    canvas = np.ones((2 * tile_size, 2 * tile_size, 4), dtype=np.float32)
+    filled_width = filled_height = 0
+    for d_row in (0, 1):
+        for d_col in (0, 1):
+            if (2 * col + d_col) * tile_size >= next_size[0] or \
+                    (2 * row + d_row) * tile_size >= next_size[1]:
+                continue
+            image = mpimg.imread(_tile_path(files, level + 1, 2 * col + d_col,
+                                            2 * row + d_row))
+            if image.shape[2] == 3:
+                image = np.dstack([image, np.ones(image.shape[:2],
+                                                  dtype=image.dtype)])
+            h, w = image.shape[:2]
+            canvas[d_row * tile_size:d_row * tile_size + h,
+                   d_col * tile_size:d_col * tile_size + w] = image
+            filled_width = max(filled_width, d_col * tile_size + w)
+            filled_height = max(filled_height, d_row * tile_size + h)
+
+    # An odd last row or column is averaged with a copy of itself
+    canvas = canvas[:filled_height, :filled_width]
+    if filled_height % 2:
+        canvas = np.concatenate([canvas, canvas[-1:]], axis=0)
+    if filled_width % 2:
+        canvas = np.concatenate([canvas, canvas[:, -1:]], axis=1)
+    halved = (canvas[0::2, 0::2] + canvas[1::2, 0::2] +
+              canvas[0::2, 1::2] + canvas[1::2, 1::2]) / 4
+    return halved
+
+
+def write_tiles(directory, scene, config, tile_size=256, title=""):
+    """Write the scene as a Deep Zoom pyramid of PNG tiles in directory,
+    along with its descriptor graph.dzi and the viewer index.html.  The
+    full image is as large as the image file of the same config would be.
+
+    The most detailed level is drawn one tile at a time, and every coarser
+    level is made by halving four tiles of the level below it, so no more
+    than a few tiles are held in memory at once.
+    """
+    import matplotlib.image as mpimg
+
+    if tile_size < 1:
+        raise util.TreeCLIError("Tile size must be at least 1")
+    width = int(round(config["img_y_height_inches"] * config["aspect_ratio"] *
+                      config["dpi"]))
+    height = int(round(config["img_y_height_inches"] * config["dpi"]))
+    max_level = int(math.ceil(math.log2(max(width, height, 2))))
+    files_name = DZI_NAME + "_files"
+    files = os.path.join(directory, files_name)
+
+    def tiles_of(level):
+        level_width, level_height = _level_size(width, height, max_level,
+                                                level)
+        for row in range(int(math.ceil(level_height / tile_size))):
+            for col in range(int(math.ceil(level_width / tile_size))):
+                yield (col, row,
+                       min(tile_size, level_width - col * tile_size),
+                       min(tile_size, level_height - row * tile_size))
+
+    os.makedirs(os.path.join(files, str(max_level)), exist_ok=True)
+    renderer = TileRenderer(scene, config, width, height)
+    num_tiles = 0
+    try:
+        for col, row, tile_width, tile_height in tiles_of(max_level):
+            renderer.render(_tile_path(files, max_level, col, row),
+                            col * tile_size, row * tile_size, tile_width,
+                            tile_height)
+            num_tiles += 1
+    finally:
+        renderer.close()
+    logger.info("Drew {} tiles of a {}x{} image".format(num_tiles, width,
+                                                          height))
+
+    for level in range(max_level - 1, -1, -1):
+        os.makedirs(os.path.join(files, str(level)), exist_ok=True)
+        next_size = _level_size(width, height, max_level, level + 1)
+        for col, row, _width, _height in tiles_of(level):
+            mpimg.imsave(_tile_path(files, level, col, row),
+                         _downsample(files, level, col, row, next_size,
+                                     tile_size))
+
+    with open(os.path.join(directory, DZI_NAME + ".dzi"), "w") as f:
+        f.write(DZI_TEMPLATE.format(tile_size=tile_size, width=width,
+                                    height=height))
+    with open(os.path.join(directory, "index.html"), "w") as f:
+        f.write(VIEWER_TEMPLATE.format(title=html.escape(title), width=width,
+                                       height=height, tile_size=tile_size,
+                                       max_level=max_level,
+                                       files=files_name))
+    logger.info("Wrote tiles: {}".format(directory))
@@ -6,25 +6,22 @@ import configparser
 import itertools
 import os
 import random
-import shlex
-import subprocess
+import sqlite3
 import sys
-import tempfile
 import logging
-import csv
-
-import pandas as pd
-import networkx as nx
-import pygraphviz as pgv
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import warnings
 warnings.filterwarnings("ignore")
 
-
-from . import util
-from .graph_objects import Node, Edge
+# NumPy and matplotlib take most of the startup time, so they, and the
+# layout module that needs NumPy, are only imported by the code that lays out
+# and draws the graph.  Text output only needs the standard library.
+from . import export, nixstore, util
+from .coarsen import COARSEN_MODES, coarsen
+from .cache import ClosureCache, DEFAULT_MAX_PATHS, default_cache_dir
+from .nixdb import NixDatabase, DEFAULT_DB
+from .graph_objects import (assign_levels, compressed_adjacency, hops,
+                            transitive_reduction)
+from .metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
@@ -51,88 +48,447 @@ CONFIG_OPTIONS = {
     "max_node_size_over_min_node_size": (5.0, float),
     "min_node_size": (100.0, float),
     "tmax": (30.0, float),
-    "show_labels": (1, int)
+    "show_labels": (1, int),
+    "min_label_pixels": (4.0, float),
+    "layout_engine": ("numpy", str),
+    "convergence_tolerance": (0.0, float),
+    "timestep_growth": (1.1, float),
+    "timestep_shrink": (0.5, float),
+    "repulsion_mode": ("exact", str),
+    "repulsion_near_cells": (8, int),
+    "incremental_iterations": (20, int),
+    "highlight_changes": (0, int),
+    "added_color": ("#2ca02c", str),
+    "removed_color": ("#d62728", str),
+    "transitive_reduction": (0, int),
+    "initializer": ("barycentric", str),
+    "ordering_sweeps": (4, int),
+    "trial_score": ("crossings", str),
+    "tile_size": (256, int)
 }
 
-def _is_csv_out(filename):
-    _fname, extension = os.path.splitext(filename)
-    fileformat = extension[1:]
-    return bool(fileformat == "csv")
+#: Places dependency graphs can be read from
+GRAPH_SOURCES = ("auto", "db", "nix-store")
 
-class Graph(object):
-    """Class representing a dependency tree"""
+#: Names of the available horizontal position solvers
+LAYOUT_ENGINES = ("numpy", "reference")
 
-    def __init__(self, packages, config, output_file, do_write=True):
-        """Initialize a graph from the result of a nix-store command"""
+#: The config options that change where nodes are placed.  A layout can be
+#: reused for any config that agrees with it on these
+LAYOUT_OPTIONS = ("y_sublevels", "y_sublevel_spacing", "num_iterations",
+                  "max_displacement", "top_level_spacing",
+                  "repulsive_force_normalization",
+                  "attractive_force_normalization", "tmax", "layout_engine",
+                  "convergence_tolerance", "timestep_growth",
+                  "timestep_shrink", "repulsion_mode", "repulsion_near_cells",
+                  "transitive_reduction", "initializer", "ordering_sweeps",
+                  "trial_score")
 
-        csv_out = _is_csv_out(output_file)
-        if csv_out:
-            logger.info("CSV output: skip parsing visualization config file")
-        else:
-            self.config = self._parse_config(config)
+#: The number of layouts kept in the layout memo directory
+MAX_MEMO_LAYOUTS = 100
 
-        self.nodes = []
-        self.edges = []
+def _is_text_out(filename):
+    _fname, extension = os.path.splitext(filename)
+    return extension in export.WRITERS
 
-        self.root_package_names = [os.path.basename(x) for x in packages]
 
-        for package in packages:
-            # Run nix-store -q --graph <package>.  This generates a graphviz
-            # file with package dependencies
-            cmd = ("nix-store -q --graph {}".format(package))
-            res = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
+def _import_pyplot():
+    """Import pyplot set up to draw without a display"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
-            stdout, stderr = res.communicate()
+class Graph(object):
+    """Class representing a dependency tree"""
 
-            if res.returncode != 0:
-                raise util.TreeCLIError("nix-store call failed, message "
-                                        "{}".format(stderr))
+    def __init__(self, packages, config, output_file, do_write=True, jobs=1,
+                 cache=None, source=None, layout_in=None, layout_out=None,
+                 layout_memo_dir=None, previous_layout=None, metrics=None,
+                 coarsen_mode=None, focus=None, why=None, depth=None,
+                 seed=None, layout_trials=1, tiles_dir=None):
+        """Initialize a graph from the result of a nix-store command.  The
+        closures of up to jobs packages are queried at the same time, and
+        looked up in the ClosureCache cache first if one is given.
+
+        Closures can instead be read from any other source, an object whose
+        query_closures(packages) method yields results in the same form as
+        nixstore.query_closures, such as a nixdb.NixDatabase.
+
+        output_file may be a single filename or a list of them.  Node
+        positions are read from the layout file layout_in if given, else
+        from layout_memo_dir if it holds a layout of the same graph made with
+        the same layout options, and are computed otherwise.  They are saved
+        to layout_out and to layout_memo_dir.
+
+        If previous_layout names a layout file of an earlier version of the
+        graph, positions are instead updated from it incrementally, and the
+        packages added and removed since are kept in self.added and
+        self.removed.
+
+        Instead of the whole graph, only the packages within depth links of
+        the package focus, or only those on the dependency paths from
+        why[0] to why[1], may be kept, see _select.
+
+        If coarsen_mode is one of COARSEN_MODES, packages are grouped into
+        clusters, which are laid out and drawn in their place.  The packages
+        stay in self.packages, and text outputs list them with their
+        clusters.
+
+        If seed is given, random numbers are seeded with it, so that the
+        same graph gives the same image every time.  If layout_trials is
+        more than 1, that many layouts are computed from different seeds in
+        parallel and the best is kept, see _add_pos_to_nodes.
+
+        If tiles_dir is given, the image is also written there as a pyramid
+        of tiles with a page to view it, see write_tiles.
+
+        The time and memory taken by every phase are recorded in metrics, a
+        metrics.Metrics, which is kept in self.metrics.
+        """
 
-            package_nodes, package_edges = self._get_edges_and_nodes(stdout)
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        if layout_in is not None and previous_layout is not None:
+            raise util.TreeCLIError("A layout cannot be both read and "
+                                    "updated incrementally")
+        if focus is not None and why is not None:
+            raise util.TreeCLIError("Only one of a focus package and a why "
+                                    "query can be given")
+        if depth is not None and focus is None and why is None:
+            raise util.TreeCLIError("A depth needs a focus package or a why "
+                                    "query")
+        if depth is not None and depth < 0:
+            raise util.TreeCLIError("Depth must not be negative")
+        if layout_trials < 1:
+            raise util.TreeCLIError("The number of layout trials must be at "
+                                    "least 1")
+        self.seed = seed
+        self.layout_trials = layout_trials
+        if seed is not None:
+            random.seed(seed)
+        self.added = []
+        self.removed = []
+
+        if isinstance(output_file, str):
+            output_file = [output_file]
+        text_outputs = [f for f in output_file if _is_text_out(f)]
+        image_outputs = [f for f in output_file if not _is_text_out(f)]
+        need_layout = bool(image_outputs or layout_out or tiles_dir)
+        if need_layout:
+            self.config = self._parse_config(config)
+        else:
+            logger.info("Text output: skip parsing visualization config file")
 
-            self.nodes.extend(package_nodes)
-            self.edges.extend(package_edges)
+        self.root_package_names = [os.path.basename(x) for x in packages]
 
-        self.nodes = list(set(self.nodes))
+        if source is None:
+            source = nixstore.NixStoreSource(jobs, cache)
+        # Closures are parsed while they are being queried, so querying and
+        # parsing are measured together
+        with self.metrics.phase("query"):
+            self._add_closures(packages, source)
 
-        self._add_edges_to_nodes()
+        with self.metrics.phase("link"):
+            self._add_edges_to_nodes()
 
-        # The package itself is level 0, its direct dependencies are
-        # level 1, their direct dependencies are level 2, etc.
-        for n in self.nodes:
-            n.add_level()
+        with self.metrics.phase("levels"):
+            # The package itself is level 0, its direct dependencies are
+            # level 1, their direct dependencies are level 2, etc.
+            assign_levels(self.nodes)
+            self._index_levels()
 
-        self.depth = max([x.level for x in self.nodes]) + 1
+        if focus is not None or why is not None:
+            with self.metrics.phase("select"):
+                self._select(focus, why, depth)
 
         logger.info("Graph has {} nodes, {} edges and a depth of {}".format(
                     len(self.nodes), len(self.edges), self.depth))
-
-        # Transform the Nodes and Edges into a networkx graph
-        self.G = nx.DiGraph()
-        for node in self.nodes:
-            self.G.add_node(node)
-            for parent in node.parents:
-                self.G.add_edge(node, parent)
-
-        if csv_out:
-            self._output_csv(output_file)
+        self.metrics.stats.update(
+            nodes=len(self.nodes), edges=len(self.edges),
+            links=len(self.parent_idx), depth=self.depth,
+            widest_level=max(len(level) for level in self.levels()))
+
+        if need_layout:
+            with self.metrics.phase("reduce"):
+                self._reduce_edges()
+        with self.metrics.phase("coarsen"):
+            self._coarsen(coarsen_mode)
+
+        for filename in text_outputs:
+            with self.metrics.phase("write", output=filename):
+                self._output_text(filename)
+
+        if need_layout:
+            with self.metrics.phase("layout"):
+                self._add_layout(layout_in, layout_out, layout_memo_dir,
+                                 previous_layout)
+            if do_write is True:
+                for filename in image_outputs:
+                    with self.metrics.phase("render", output=filename):
+                        self.write_frame_image(filename=filename)
+                if tiles_dir is not None:
+                    with self.metrics.phase("tiles", output=tiles_dir):
+                        self.write_tiles(tiles_dir)
+
+    def _select(self, focus=None, why=None, depth=None):
+        """Cut the graph down to the packages a query asks about, and lay
+        out and draw only those.  With focus, they are the packages within
+        depth links of it, the packages it depends on and the packages that
+        depend on it.  With why, a (root, target) pair, they are the packages
+        on every dependency path from root to target no longer than depth
+        links.  depth None means no limit.
+        """
+        num_nodes = len(self.nodes)
+        if focus is not None:
+            node = self._find_node(focus)
+            keep = set(hops(node, "children", depth))
+            keep.update(hops(node, "parents", depth))
+        else:
+            root, target = (self._find_node(name) for name in why)
+            down = hops(root, "children")
+            up = hops(target, "parents")
+            keep = {i for i in down if i in up and
+                    (depth is None or down[i] + up[i] <= depth)}
+            if not keep:
+                raise util.TreeCLIError("{} does not depend on {}{}".format(
+                    root, target, "" if depth is None else
+                    " within {} links".format(depth)))
+
+        self.nodes = [n for n in self.nodes if n.index in keep]
+        names = {n.raw_name for n in self.nodes}
+        self.edges = [e for e in self.edges
+                      if e.nfrom in names and e.nto in names]
+        for n in self.nodes:
+            n.parents = []
+            n.children = []
+            n.in_degree = 0
+            n.out_degree = 0
+        self._add_edges_to_nodes()
+        assign_levels(self.nodes)
+        self._index_levels()
+        logger.info("Selected {} of {} packages".format(len(self.nodes),
+                                                        num_nodes))
+        if why is not None:
+            self._log_why(root, target)
+
+    def _log_why(self, root, target):
+        """Report how many dependency paths lead from root to target in the
+        selected graph, and the shortest of them
+        """
+        paths = [0] * len(self.nodes)
+        paths[root.index] = 1
+        for level in self.levels():
+            for n in level:
+                for child in n.children:
+                    paths[child.index] += paths[n.index]
+
+        # Walk back up from the target along the packages one link nearer
+        # to the root
+        down = hops(root, "children")
+        chain = [target]
+        while chain[-1] is not root:
+            distance = down[chain[-1].index] - 1
+            chain.append(next(p for p in chain[-1].parents
+                              if down.get(p.index) == distance))
+        logger.info("{} depends on {} through {} paths among the selected "
+                    "packages, the shortest is {}".format(
+                        root, target, paths[target.index],
+                        " -> ".join(repr(n) for n in reversed(chain))))
+
+    def _find_node(self, name):
+        """Return the node of a package given by store path, by name with
+        its hash, or by name alone if that is unambiguous
+        """
+        name = os.path.basename(name)
+        if name in self.node_index:
+            return self.nodes[self.node_index[name]]
+        matches = [n for n in self.nodes
+                   if util.remove_nix_hash(n.raw_name) == name]
+        if len(matches) == 1:
+            return matches[0]
+        if not matches:
+            raise util.TreeCLIError("No package named {} in the "
+                                    "graph".format(name))
+        raise util.TreeCLIError("{} names several packages, give one of: "
+                                "{}".format(name, ", ".join(
+                                    n.raw_name for n in matches)))
+
+    def _reduce_edges(self):
+        """Drop the links implied by other links if the transitive_reduction
+        option is set, so that layout and drawing only handle the links that
+        show the structure of the graph
+        """
+        if not self.config["transitive_reduction"]:
+            return
+        num_links = len(self.parent_idx)
+        removed = transitive_reduction(self.nodes)
+        self.parent_ptr, self.parent_idx = compressed_adjacency(self.nodes,
+                                                                "parents")
+        self.child_ptr, self.child_idx = compressed_adjacency(self.nodes,
+                                                              "children")
+        logger.info("Transitive reduction removed {} of {} links".format(
+            removed, num_links))
+        self.metrics.stats["links_removed"] = removed
+
+    def _coarsen(self, mode):
+        """Replace the nodes by clusters of packages if mode is set, so that
+        layout and drawing handle one node per cluster.  self.link_weights
+        holds the number of links between packages that each link between
+        clusters stands for, in the order of self.parent_idx.
+        """
+        self.packages = self.nodes
+        self.link_weights = None
+        if mode is None:
+            return
+        num_links = len(self.parent_idx)
+        self.nodes, self.edges, weights = coarsen(self.packages, mode)
+        self._add_edges_to_nodes()
+        self._index_levels()
+        self.link_weights = [weights[(n.raw_name, p.raw_name)]
+                             for n in self.nodes for p in n.parents]
+        logger.info("Coarsened {} packages and {} links by {} into {} "
+                    "clusters and {} links".format(
+                        len(self.packages), num_links, mode, len(self.nodes),
+                        len(self.parent_idx)))
+        self.metrics.stats.update(clusters=len(self.nodes),
+                                  cluster_links=len(self.parent_idx))
+
+    def _add_layout(self, layout_in=None, layout_out=None, memo_dir=None,
+                    previous_layout=None):
+        """Give every node a position, reusing a saved layout if possible"""
+        from .layout import (content_hash, count_crossings, read_layout,
+                             write_layout)
+
+        graph_hash = self._graph_hash()
+        layout_options = {k: self.config[k] for k in LAYOUT_OPTIONS}
+        if self.seed is not None:
+            layout_options["seed"] = self.seed
+        if self.layout_trials > 1:
+            layout_options["layout_trials"] = self.layout_trials
+        config_hash = content_hash(layout_options)
+        memo = None
+        if memo_dir is not None:
+            memo = os.path.join(memo_dir, "{}-{}.json".format(
+                graph_hash[:32], config_hash[:32]))
+
+        self.metrics.stats["layout_iterations"] = 0
+        if layout_in is not None:
+            self.metrics.stats["layout_source"] = "file"
+            self._apply_layout(read_layout(layout_in), layout_in, graph_hash)
+        elif previous_layout is not None:
+            # An incremental layout depends on its history, so it is not
+            # memoized
+            self.metrics.stats["layout_source"] = "incremental"
+            self._add_pos_incremental(read_layout(previous_layout))
+        elif memo is not None and os.path.exists(memo) and \
+                self._apply_memo(memo, graph_hash, config_hash):
+            self.metrics.stats["layout_source"] = "memo"
         else:
+            self.metrics.stats["layout_source"] = "computed"
             self._add_pos_to_nodes()
-            if do_write is True:
-                self.write_frame_image(filename=output_file)
-
-    def _output_csv(self, filename):
-        df = pd.DataFrame.from_records([node.to_dict() for node in self.nodes])
-        df.sort_values(by=["level"], ascending=False, inplace=True)
-        df.to_csv(
-            path_or_buf=filename,
-            quoting=csv.QUOTE_ALL,
-            sep=",",
-            index=False,
-            encoding="utf-8"
-        )
-        logger.info("Wrote: %s", filename)
+            if memo is not None:
+                self._save_memo(memo, graph_hash, config_hash)
+
+        if layout_out is not None:
+            write_layout(layout_out, self._layout_state(graph_hash,
+                                                        config_hash))
+
+        crossings = count_crossings([n.level for n in self.nodes],
+                                    [n.x for n in self.nodes],
+                                    self.parent_ptr, self.parent_idx)
+        logger.info("Layout has {} edge crossings".format(crossings))
+        self.metrics.stats["crossings"] = crossings
+
+    def _graph_hash(self):
+        """Identify the graph by its packages and dependencies, regardless of
+        the order they were found in
+        """
+        from .layout import content_hash
+
+        names = [n.raw_name for n in self.nodes]
+        links = sorted([names[i], names[self.parent_idx[j]]]
+                       for i in range(len(names))
+                       for j in range(self.parent_ptr[i],
+                                      self.parent_ptr[i + 1]))
+        return content_hash({"nodes": sorted(names), "edges": links})
+
+    def _layout_state(self, graph_hash, config_hash):
+        """Return the node positions in the form write_layout saves"""
+        return {
+            "graph_hash": graph_hash,
+            "config_hash": config_hash,
+            "names": [n.raw_name for n in self.nodes],
+            "levels": [n.level for n in self.nodes],
+            "x": [n.x for n in self.nodes],
+            "y": [n.y for n in self.nodes],
+            "edges": [[i, self.parent_idx[j]]
+                      for i in range(len(self.nodes))
+                      for j in range(self.parent_ptr[i],
+                                     self.parent_ptr[i + 1])],
+        }
+
+    def _apply_layout(self, layout, filename, graph_hash):
+        """Take node positions from a saved layout of this same graph"""
+        if layout["graph_hash"] != graph_hash:
+            raise util.TreeCLIError("Layout {} was made for a different "
+                                    "dependency graph".format(filename))
+        positions = {name: (x, y) for name, x, y in zip(
+            layout["names"], layout["x"], layout["y"])}
+        for n in self.nodes:
+            n.x, n.y = positions[n.raw_name]
+
+    def _apply_memo(self, memo, graph_hash, config_hash):
+        """Take node positions from a layout in the memo directory, and
+        return whether it could be used.  The memo is only a cache, so one
+        that is unreadable or was made for another graph or other options is
+        ignored, to be replaced by a freshly computed layout.
+        """
+        from .layout import read_layout
+
+        try:
+            layout = read_layout(memo)
+            if layout.get("config_hash") != config_hash:
+                raise util.TreeCLIError("Layout {} was made with other layout "
+                                        "options".format(memo))
+            self._apply_layout(layout, memo, graph_hash)
+        except (util.TreeCLIError, KeyError, TypeError, ValueError) as e:
+            logger.warning("Not reusing saved layout {}, recomputing it: "
+                           "{!r}".format(memo, e))
+            return False
+
+        logger.info("Reusing layout from {}".format(memo))
+        try:
+            os.utime(memo)
+        except OSError:
+            pass
+        return True
+
+    def _save_memo(self, memo, graph_hash, config_hash):
+        """Add the current layout to the memo directory, dropping the least
+        recently used layouts once there are more than MAX_MEMO_LAYOUTS
+        """
+        from .layout import write_layout
+
+        try:
+            memo_dir = os.path.dirname(memo)
+            os.makedirs(memo_dir, exist_ok=True)
+            write_layout(memo, self._layout_state(graph_hash, config_hash))
+            memos = sorted((os.path.join(memo_dir, f)
+                            for f in os.listdir(memo_dir)
+                            if f.endswith(".json")), key=os.path.getmtime)
+            for old in memos[:-MAX_MEMO_LAYOUTS]:
+                os.remove(old)
+        except OSError as e:
+            logger.warning("Could not save layout to {}: {}".format(memo, e))
+
+    def _output_text(self, filename):
+        """Write the packages to a csv or jsonl file, chosen by extension"""
+        _fname, extension = os.path.splitext(filename)
+        columns = export.COLUMNS
+        if self.link_weights is not None:
+            columns = export.CLUSTER_COLUMNS
+        export.WRITERS[extension](filename, self.packages, columns)
 
     def _parse_config(self, config, verbose=True):
         """Load visualization parameters from config file or take defaults
@@ -180,8 +536,15 @@ class Graph(object):
 
         return return_configs
 
-    def write_frame_image(self, filename="nix-tree.png"):
-        """Dump the graph to an image file"""
+    def _scene(self):
+        """Return what is drawn of the graph as arrays, in a dictionary:
+        the colormap, the x and y positions, colors, sizes and labels of the
+        nodes, the segments and widths of the edges, from each node to each
+        of its parents, and the (x, y) limits of the data that the image
+        shows.  labels is None if they are not drawn.
+        """
+        import numpy as np
+        import matplotlib
 
         try:
             cmap = getattr(matplotlib.cm, self.config["color_map"])
@@ -189,44 +552,142 @@ class Graph(object):
             raise util.TreeCLIError("Colormap {} does not exist".format(
                 self.config["color_map"]))
 
-        pos = {n: (n.x, n.y) for n in self.nodes}
+        xs = np.array([n.x for n in self.nodes], dtype=float)
+        ys = np.array([n.y for n in self.nodes], dtype=float)
         col_scale = 255.0/(self.depth+1.0)
         col = [(x.level+random.random()*self.config["color_scatter"])*col_scale
-               for x in self.G.nodes()]
-        col = [min([x,255]) for x in col]
-
-        img_y_height=self.config["img_y_height_inches"]
+               for x in self.nodes]
+        col = np.array([min([x,255]) for x in col], dtype=float)
 
         size_min = self.config["min_node_size"]
         size_max = self.config["max_node_size_over_min_node_size"] * size_min
+        node_size = np.array([min(size_min + (x.out_degree-1)*
+                                  self.config["add_size_per_out_link"],
+                                  size_max) if x.level > 0 else size_max for
+                              x in self.nodes], dtype=float)
+
+        child = np.repeat(np.arange(len(self.nodes)),
+                          np.diff(np.asarray(self.parent_ptr)))
+        parent = np.asarray(self.parent_idx, dtype=np.intp)
+        widths = np.asarray(self.config["edge_width_scale"], dtype=float)
+        if self.link_weights is not None:
+            # A link between clusters is as wide as the links it stands for
+            widths = widths * np.sqrt(self.link_weights)
+        segments = np.stack([np.column_stack([xs[child], ys[child]]),
+                             np.column_stack([xs[parent], ys[parent]])],
+                            axis=1).reshape(-1, 2, 2)
+
+        # The limits matplotlib would pick: a margin around the edges, as
+        # networkx leaves, and then the default axes margins
+        points = [np.column_stack([xs, ys])]
+        if len(segments) > 0:
+            low = segments.reshape(-1, 2).min(axis=0)
+            high = segments.reshape(-1, 2).max(axis=0)
+            pad = 0.05 * (high - low)
+            points += [[low - pad], [high + pad]]
+        points = np.concatenate(points)
+        low, high = points.min(axis=0), points.max(axis=0)
+        margin = matplotlib.rcParams["axes.xmargin"] * (high - low)
+        margin[margin == 0] = 0.05 * np.maximum(np.abs(low[margin == 0]), 1)
+        limits = tuple(zip(low - margin, high + margin))
+
+        labels = None
+        if self._label_font_size() is not None:
+            labels = [repr(n) for n in self.nodes]
+
+        return {"cmap": cmap, "x": xs, "y": ys, "colors": col,
+                "sizes": node_size, "labels": labels, "segments": segments,
+                "widths": widths, "limits": limits, "size_max": size_max}
+
+    def write_frame_image(self, filename="nix-tree.png"):
+        """Dump the graph to an image file.  All edges are drawn as a single
+        LineCollection and all nodes as a single scatter, straight from the
+        node positions.
+        """
+        from matplotlib.collections import LineCollection
+        plt = _import_pyplot()
 
-        plt.figure(1, figsize=(img_y_height*self.config["aspect_ratio"],
-                               img_y_height))
-        node_size = [min(size_min + (x.out_degree-1)*
-                         self.config["add_size_per_out_link"],
-                         size_max) if x.level > 0 else size_max for
-                     x in self.G.nodes()]
-
-        # Draw edges
-        nx.draw(self.G, pos, node_size=node_size,  arrows=False,
-             with_labels=self.config["show_labels"],
-             edge_color=self.config["edge_color"],
-             font_size=12*self.config["font_scale"],
-             node_color=col, vmin=0, vmax=256,
-             width=self.config["edge_width_scale"],
-             alpha=self.config["edge_alpha"], nodelist=[])
-
-        # Draw nodes
-        nx.draw(self.G, pos, node_size=node_size,  arrows=False,
-             with_labels=self.config["show_labels"],
-             font_size=12*self.config["font_scale"],
-             node_color=col, vmin=0, vmax=255, edgelist=[],
-             font_weight="light", cmap=cmap,
-             font_color=self.config["font_color"])
+        scene = self._scene()
+        img_y_height=self.config["img_y_height_inches"]
+        fig = plt.figure(1, figsize=(img_y_height*self.config["aspect_ratio"],
+                                     img_y_height))
+        fig.set_facecolor("w")
+        ax = fig.add_axes((0, 0, 1, 1))
+        ax.set_axis_off()
+
+        ax.add_collection(LineCollection(
+            scene["segments"], colors=self.config["edge_color"],
+            linewidths=scene["widths"], antialiaseds=(1,),
+            alpha=self.config["edge_alpha"], zorder=1))
+        ax.scatter(scene["x"], scene["y"], s=scene["sizes"],
+                   c=scene["colors"], cmap=scene["cmap"], vmin=0, vmax=255,
+                   zorder=2)
+        if self.config["highlight_changes"]:
+            self._draw_changes(ax, scene["size_max"])
+        (x_low, x_high), (y_low, y_high) = scene["limits"]
+        ax.set_xlim(x_low, x_high)
+        ax.set_ylim(y_low, y_high)
+
+        if scene["labels"] is not None:
+            self._draw_labels(ax, scene["labels"])
 
         logger.info("Writing image file: {}".format(filename))
-        plt.savefig(filename, dpi=self.config["dpi"])
-        plt.close()
+        # pyplot.savefig would draw the whole figure a second time after
+        # saving it
+        fig.savefig(filename, dpi=self.config["dpi"])
+        plt.close(fig)
+
+    def write_tiles(self, directory):
+        """Dump the graph to a Deep Zoom pyramid of image tiles in
+        directory, with a page to view it, see tiles.write_tiles
+        """
+        from . import tiles
+
+        if self.config["highlight_changes"]:
+            logger.warning("Tiles do not highlight changes, draw an image "
+                           "file to see them")
+        tiles.write_tiles(directory, self._scene(), self.config,
+                          tile_size=self.config["tile_size"],
+                          title=", ".join(self.root_package_names))
+
+    def _draw_changes(self, ax, size):
+        """Ring the packages added since the previous layout, and mark where
+        the removed packages used to be
+        """
+        if self.added:
+            ax.scatter([n.x for n in self.added], [n.y for n in self.added],
+                       s=2 * size, facecolors="none",
+                       edgecolors=self.config["added_color"], linewidths=2,
+                       zorder=3)
+        if self.removed:
+            ax.scatter([x for _name, x, _y in self.removed],
+                       [y for _name, _x, y in self.removed], s=size,
+                       marker="x", c=self.config["removed_color"],
+                       linewidths=2, zorder=3)
+
+    def _label_font_size(self):
+        """Return the font size of node labels, or None if they are not
+        drawn, because the font would be too small to read at the output
+        resolution
+        """
+        if not self.config["show_labels"]:
+            return None
+        font_size = 12*self.config["font_scale"]
+        pixels = font_size * self.config["dpi"] / 72.0
+        if pixels < self.config["min_label_pixels"]:
+            logger.info("Labels would be {:.1f} pixels high, not drawing "
+                        "them".format(pixels))
+            return None
+        return font_size
+
+    def _draw_labels(self, ax, labels):
+        """Label every node with its package name"""
+        font_size = 12*self.config["font_scale"]
+        for n, label in zip(self.nodes, labels):
+            ax.text(n.x, n.y, label, size=font_size,
+                    color=self.config["font_color"], weight="light",
+                    horizontalalignment="center",
+                    verticalalignment="center", clip_on=True)
 
     def _add_pos_to_nodes(self):
         """Populates every node with an x an y position using the following
@@ -241,13 +702,188 @@ class Graph(object):
            * advance time forward by dt=tmax/num_iterations, displace particles
              by F*dt
            * repeat until the number of iterations has been exhausted
-        """
 
-        logger.info("Adding positions to nodes")
+        Unless the initializer config option is "random", the starting x
+        positions, which are random, are first reordered level by level to
+        reduce edge crossings, see layout.layered_positions, so that the
+        solver starts close to a good layout.
+
+        The work is done by the solver named by the layout_engine config
+        option: "numpy" (the default) advances a whole level at a time with
+        array operations, "reference" is the original per-node loop.
+
+        With layout_trials above 1, the numpy solver runs that many times in
+        parallel processes, from seeds counting up from the seed given or
+        from a random one, and the layout with the lowest trial_score is
+        kept, see layout.search_layouts.
+        """
+        from .layout import (INITIALIZERS, LEVEL_HEIGHT, REPULSION_MODES,
+                             TRIAL_SCORES, search_layouts, solve_layout,
+                             start_positions)
+
+        engine = self.config["layout_engine"]
+        if engine not in LAYOUT_ENGINES:
+            raise util.TreeCLIError("Unknown layout_engine {}, choose one "
+                                    "of {}".format(engine,
+                                                   ", ".join(LAYOUT_ENGINES)))
+
+        repulsion = self.config["repulsion_mode"]
+        if repulsion not in REPULSION_MODES:
+            raise util.TreeCLIError("Unknown repulsion_mode {}, choose one "
+                                    "of {}".format(repulsion,
+                                                   ", ".join(REPULSION_MODES)))
+
+        initializer = self.config["initializer"]
+        if initializer not in INITIALIZERS:
+            raise util.TreeCLIError("Unknown initializer {}, choose one of "
+                                    "{}".format(initializer,
+                                                ", ".join(INITIALIZERS)))
+
+        score = self.config["trial_score"]
+        if score not in TRIAL_SCORES:
+            raise util.TreeCLIError("Unknown trial_score {}, choose one of "
+                                    "{}".format(score,
+                                                ", ".join(TRIAL_SCORES)))
+
+        logger.info("Adding positions to nodes using the {} engine".format(
+            engine))
+
+        graph = ([n.level for n in self.nodes], self.parent_ptr,
+                 self.parent_idx, self.child_ptr, self.child_idx)
+
+        if engine == "reference":
+            if self.config["convergence_tolerance"] > 0:
+                logger.warning("The reference engine ignores "
+                               "convergence_tolerance")
+            if repulsion != "exact":
+                logger.warning("The reference engine ignores repulsion_mode")
+            if self.layout_trials > 1:
+                logger.warning("The reference engine ignores layout trials")
+            x0, crossings = start_positions(*graph, config=self.config)
+            if crossings is not None:
+                self.metrics.stats["initial_crossings"] = crossings
+            for n, x in zip(self.nodes, x0):
+                n.x = float(x)
+                if n.level == 0:
+                    n.y = self.depth * LEVEL_HEIGHT
+            self._add_pos_to_nodes_reference()
+            self.metrics.stats["layout_iterations"] = self.config[
+                "num_iterations"]
+            return
+
+        if self.layout_trials > 1:
+            first = self.seed
+            if first is None:
+                first = random.randrange(1 << 31)
+            seeds = list(range(first, first + self.layout_trials))
+            workers = min(self.layout_trials, os.cpu_count() or 1)
+            logger.info("Searching {} layouts on {} processes, scored by "
+                        "{}".format(len(seeds), workers, score))
+            (seed, best, xs, ys, stats), scores = search_layouts(
+                *graph, config=self.config, seeds=seeds, score=score,
+                workers=workers)
+            logger.info("Best of {} layouts scores {:.10g} by {}, rerun "
+                        "with --seed {} to get it alone".format(
+                            len(seeds), best, score, seed))
+            self.metrics.stats.update(layout_seed=seed, trial_scores=scores)
+        else:
+            xs, ys, stats = solve_layout(*graph, config=self.config)
+        self.metrics.stats.update(stats)
+        for n, x, y in zip(self.nodes, xs, ys):
+            n.x = float(x)
+            n.y = float(y)
+
+    def _add_pos_incremental(self, previous):
+        """Populate node positions by updating the layout of an earlier
+        version of the graph rather than solving from scratch.
+
+        Packages that were in the previous layout start where they were.  New
+        packages start at the mean position of their parents, or to the right
+        of the other roots if they are roots.  Only new packages, packages
+        whose level or parents changed, and the dependencies of those are then
+        moved, for incremental_iterations iterations, so the work depends on
+        the size of the change rather than the size of the graph.
+        """
+        import numpy as np
+        from .layout import LayoutEngine, LEVEL_HEIGHT
+
+        if self.config["layout_engine"] != "numpy":
+            logger.warning("Incremental layout always uses the numpy engine")
+
+        names = previous["names"]
+        old_index = {name: i for i, name in enumerate(names)}
+        old_parents = [set() for _ in names]
+        for child, parent in previous["edges"]:
+            old_parents[child].add(names[parent])
+        old_depth = max(previous["levels"]) + 1 if names else 0
+
+        spacing = self.config["top_level_spacing"]
+        next_root = max([x for x, level in zip(previous["x"],
+                                               previous["levels"])
+                         if level == 0] or [-spacing]) + spacing
+
+        x0 = np.zeros(len(self.nodes))
+        changed = np.zeros(len(self.nodes), dtype=bool)
+        self.added = []
+        # Parents are always on a lower level than their children, so they
+        # are placed first
+        for nodes in self.levels():
+            for n in nodes:
+                i = old_index.get(n.raw_name)
+                if i is not None:
+                    x0[n.index] = previous["x"][i]
+                    changed[n.index] = (
+                        previous["levels"][i] != n.level or
+                        old_parents[i] != {p.raw_name for p in n.parents})
+                    continue
+                self.added.append(n)
+                changed[n.index] = True
+                if n.level == 0:
+                    x0[n.index] = next_root
+                    next_root += spacing
+                else:
+                    # Jitter new siblings of the same parents apart
+                    parents_x = [x0[p.index] for p in n.parents]
+                    x0[n.index] = (np.mean(parents_x) +
+                                   LEVEL_HEIGHT * (random.random() - 0.5))
+
+        # Nodes are pulled toward their parents, so follow any that moved
+        active = changed.copy()
+        for i in np.flatnonzero(changed):
+            for j in range(self.child_ptr[i], self.child_ptr[i + 1]):
+                active[self.child_idx[j]] = True
+
+        # Ghosts of removed packages stay where they were, relative to the
+        # bottom of the graph
+        shift = (self.depth - old_depth) * LEVEL_HEIGHT
+        self.removed = [(name, px, py + shift) for name, px, py in
+                        zip(names, previous["x"], previous["y"])
+                        if name not in self.node_index]
+
+        iterations = self.config["incremental_iterations"]
+        logger.info("Incremental layout: {} packages added, {} removed, "
+                    "moving {} of {} for {} iterations".format(
+                        len(self.added), len(self.removed),
+                        int(active.sum()), len(self.nodes), iterations))
+
+        solver = LayoutEngine([n.level for n in self.nodes], self.parent_ptr,
+                              self.parent_idx, self.config)
+        xs, ys = solver.run(x0, active=active, num_iterations=iterations)
+        self.metrics.stats["layout_iterations"] = solver.iterations
+        self.metrics.stats.update(added=len(self.added),
+                                  removed=len(self.removed),
+                                  moved=int(active.sum()))
+        for n, x, y in zip(self.nodes, xs, ys):
+            n.x = float(x)
+            n.y = float(y)
+
+    def _add_pos_to_nodes_reference(self):
+        """Reference implementation of the horizontal position solver, which
+        moves one node at a time.  Expects x positions to be initialized.
+        """
+        from .layout import LEVEL_HEIGHT
 
-        #: The distance between levels in arbitrary units.  Used to set a
-        #: scale on the diagram
-        level_height = 10
+        level_height = LEVEL_HEIGHT
 
         #: Maximum displacement of a point on a single iteration
         max_displacement = level_height * self.config["max_displacement"]
@@ -255,20 +891,6 @@ class Graph(object):
         #: The timestep to take on each iteration
         dt = self.config["tmax"]/self.config["num_iterations"]
 
-        number_top_level = len([x for x in self.nodes if x.level == 0])
-
-        count_top_level = 0
-        # Initialize x with a random position unless you're the top level
-        # package, then space nodes evenly
-        for n in self.nodes:
-            if n.level == 0:
-                n.x = float(count_top_level)*self.config["top_level_spacing"]
-                count_top_level += 1
-                n.y = self.depth * level_height
-            else:
-                n.x = ((number_top_level + 1) *
-                       self.config["top_level_spacing"] * random.random())
-
         for iternum in range(self.config["num_iterations"]):
             if iternum in range(0,self.config["num_iterations"],
                                 int(self.config["num_iterations"]/10)):
@@ -325,54 +947,107 @@ class Graph(object):
     def level(self, level):
         """Return a list of all nodes on a given level
         """
-        return [x for x in self.nodes if x.level == level]
+        if 0 <= level < self.depth:
+            return self._level_index[level]
+        return []
+
+    def _index_levels(self):
+        """Bucket the nodes by level, so that level() does not need to scan
+        the whole graph
+        """
+        self.depth = max([x.level for x in self.nodes]) + 1
+        self._level_index = [[] for _ in range(self.depth)]
+        for n in self.nodes:
+            self._level_index[n.level].append(n)
 
     def levels(self, min_level=0):
         """An iterator over levels, yields all the nodes in each level"""
         for i in range(min_level,self.depth):
             yield self.level(i)
 
-    def _get_edges_and_nodes(self, raw_lines):
-        """Transform a raw GraphViz file into Node and Edge objects.  Note
-        that at this point the nodes and edges are not linked into a graph
-        they are simply two lists of items."""
-
-        tempf = tempfile.NamedTemporaryFile(delete=False)
-        tempf.write(raw_lines)
-        tempf.close()
-        G = pgv.AGraph(tempf.name)
+    def _add_closures(self, packages, source):
+        """Query the closure of every package from source and merge the
+        closures into self.nodes and self.edges as each query finishes.
 
-        all_edges = []
-        all_nodes = []
+        Closures overlap heavily, so every package and dependency is kept
+        once.  Nodes and edges are ordered by the first package whose closure
+        contains them and then by name, so the graph does not depend on which
+        query happens to finish first or on whether it came from the cache.
+        """
 
-        for node in G.nodes():
-            if (node.name not in [n.raw_name for n in all_nodes]):
-                all_nodes.append(Node(node.name))
+        nodes = {}
+        edges = {}
+        failed = []
 
-        for edge in G.edges():
-            all_edges.append(Edge(edge[0], edge[1]))
+        for rank, package, closure, error in source.query_closures(packages):
+            if error is not None:
+                logger.error("Querying {} failed: {}".format(package, error))
+                failed.append(package)
+                continue
 
-        return all_nodes, all_edges
+            logger.debug("Merging closure of {}".format(package))
+            package_nodes, package_edges = closure
+            for node in package_nodes:
+                key = (rank, node.raw_name)
+                seen = nodes.get(node.raw_name)
+                if seen is None:
+                    nodes[node.raw_name] = (key, node)
+                elif key < seen[0]:
+                    nodes[node.raw_name] = (key, seen[1])
+            for edge in package_edges:
+                key = (rank, edge.nto, edge.nfrom)
+                seen = edges.get((edge.nfrom, edge.nto))
+                if seen is None:
+                    edges[(edge.nfrom, edge.nto)] = (key, edge)
+                elif key < seen[0]:
+                    edges[(edge.nfrom, edge.nto)] = (key, seen[1])
+
+        if failed:
+            raise util.TreeCLIError("Could not query {} of {} packages: "
+                                    "{}".format(len(failed), len(packages),
+                                                ", ".join(failed)))
+
+        self.nodes = [n for _key, n in sorted(nodes.values(),
+                                              key=lambda v: v[0])]
+        self.edges = [e for _key, e in sorted(edges.values(),
+                                              key=lambda v: v[0])]
 
     def _add_edges_to_nodes(self):
         """Given the lists of Edges and Nodes, add parents and children to
-        nodes by following each edge
+        nodes by following each edge.  Nodes are numbered by their position
+        in self.nodes, and the links are also stored as compressed sparse row
+        arrays of those numbers.
         """
 
+        self.node_index = {}
+        for i, n in enumerate(self.nodes):
+            n.index = i
+            self.node_index[n.raw_name] = i
+
+        num_nodes = len(self.nodes)
+        linked = set()
         for edge in self.edges:
-            nfrom = [n for n in self.nodes if n.raw_name == edge.nfrom]
-            nto = [n for n in self.nodes if n.raw_name == edge.nto]
-            nfrom = nfrom[0]
-            nto = nto[0]
+            ifrom = self.node_index[edge.nfrom]
+            ito = self.node_index[edge.nto]
 
-            if nfrom.raw_name == nto.raw_name:
+            if ifrom == ito:
                 # Disallow self-references
                 continue
 
-            if nto not in nfrom.parents:
-                nfrom.add_parent(nfrom, nto)
-            if nfrom not in nto.children:
-                nto.add_child(nfrom, nto)
+            link = ifrom * num_nodes + ito
+            if link in linked:
+                continue
+            linked.add(link)
+
+            nfrom = self.nodes[ifrom]
+            nto = self.nodes[ito]
+            nfrom.add_parent(nfrom, nto)
+            nto.add_child(nfrom, nto)
+
+        self.parent_ptr, self.parent_idx = compressed_adjacency(self.nodes,
+                                                                "parents")
+        self.child_ptr, self.child_idx = compressed_adjacency(self.nodes,
+                                                              "children")
 
     def __repr__(self):
         """Basic print of Graph, show the package name and the number of
@@ -403,6 +1078,38 @@ def init_logger(debug=False):
                          "\033[1;37m[\033[1;34mDBUG\033[1;37m]\033[0;34m")
 
 
+def _open_source(args):
+    """Return the graph source chosen by the command line arguments"""
+
+    if args.source == "db":
+        try:
+            source = NixDatabase(args.nix_db)
+        except sqlite3.Error as e:
+            raise util.TreeCLIError("Cannot read Nix database {}: "
+                                    "{}".format(args.nix_db, e))
+        logger.info("Reading dependencies from {}".format(args.nix_db))
+        return source
+
+    cache = None
+    if args.cache:
+        try:
+            cache = ClosureCache(args.cache_dir, args.cache_size)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Not using the closure cache: {}".format(e))
+    source = nixstore.NixStoreSource(args.jobs, cache)
+
+    if args.source == "auto":
+        # Packages the database cannot answer for are queried with nix-store
+        try:
+            database = NixDatabase(args.nix_db, fallback=source)
+            logger.info("Reading dependencies from {}".format(args.nix_db))
+            return database
+        except sqlite3.Error as e:
+            logger.info("Cannot read Nix database {} ({}), querying nix-store "
+                        "instead".format(args.nix_db, e))
+    return source
+
+
 def main():
     """Parse command line arguments, instantiate graph and dump image"""
     parser = argparse.ArgumentParser()
@@ -424,8 +1131,73 @@ def main():
                         "formats, the tool supports output in csv to "
                         "allow post-processing the output data. Specify "
                         "output file with .csv extension to output the "
-                        "result in textual csv format."
-                        , default="frame.png", required=False)
+                        "result in textual csv format, or with .jsonl "
+                        "for one JSON object per line. "
+                        "Give this option several times to write several "
+                        "outputs from the same layout."
+                        , action="append", required=False)
+    parser.add_argument("--layout-in", help="read node positions from a "
+                        "layout file saved by --layout-out instead of "
+                        "computing them")
+    parser.add_argument("--layout-out", help="save the node positions to a "
+                        "layout file")
+    parser.add_argument("--incremental", metavar="PREVIOUS_LAYOUT",
+                        help="update a layout file saved by --layout-out "
+                        "for an earlier version of the graph instead of "
+                        "laying it out from scratch")
+    parser.add_argument("--coarsen", choices=COARSEN_MODES,
+                        help="lay out and draw clusters of packages instead "
+                        "of single store paths: every version and output of "
+                        "a package by name, every output of a derivation by "
+                        "output, or packages along with the dependencies "
+                        "only they refer to by degree")
+    parser.add_argument("--focus", metavar="PACKAGE",
+                        help="only show this package, the packages it "
+                        "depends on and the packages that depend on it")
+    parser.add_argument("--why", nargs=2, metavar=("ROOT", "TARGET"),
+                        help="only show the packages on the dependency "
+                        "paths from ROOT to TARGET")
+    parser.add_argument("--depth", type=int,
+                        help="with --focus, only show packages at most this "
+                        "many links away, and with --why, only paths of at "
+                        "most this many links")
+    parser.add_argument("--seed", type=int, help="seed the random numbers "
+                        "used for the layout and colors, so that runs are "
+                        "reproducible")
+    parser.add_argument("--layout-trials", type=int, default=1,
+                        metavar="N", help="compute N layouts from different "
+                        "random starts in parallel processes and draw the "
+                        "one with the best trial_score")
+    parser.add_argument("--tiles", metavar="DIR", help="write the image as "
+                        "a pyramid of tiles to DIR, drawn one tile at a time "
+                        "so that huge images fit in memory, and a page "
+                        "DIR/index.html to pan and zoom it")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="number of nix-store queries to run at the "
+                        "same time, default is the number of CPUs")
+    parser.add_argument("--source", choices=GRAPH_SOURCES, default="auto",
+                        help="where to read dependency graphs from: the Nix "
+                        "store database, nix-store queries, or auto (the "
+                        "default) to use the database if it is readable and "
+                        "nix-store otherwise")
+    parser.add_argument("--nix-db", default=DEFAULT_DB,
+                        help="Nix store database to read, default is "
+                        "{}".format(DEFAULT_DB))
+    parser.add_argument("--cache-dir", help="directory holding the cache of "
+                        "store path dependency graphs, default is "
+                        "$XDG_CACHE_HOME/nix-visualize")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_PATHS,
+                        help="maximum number of store paths to keep in the "
+                        "cache, default is {}".format(DEFAULT_MAX_PATHS))
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="do not read or update the closure cache of "
+                        "nix-store queries or the saved layouts, and always "
+                        "compute the layout")
+    parser.add_argument("--metrics-json", help="write the wall time, CPU "
+                        "time and peak memory of every phase, and statistics "
+                        "of the graph, to this JSON file")
+    parser.add_argument("--profile", help="write a cProfile dump of the "
+                        "layout to this file")
     parser.add_argument('--verbose', dest='verbose', action='store_true')
     parser.add_argument('--no-verbose', dest='verbose', action='store_false')
     parser.set_defaults(verbose=False)
@@ -433,12 +1205,30 @@ def main():
 
     init_logger(debug=args.verbose)
 
+    metrics = Metrics(profile_file=args.profile)
     try:
-        graph = Graph(args.packages, (args.configfile, args.configsection),
-                  args.output)
+        with metrics.phase("open"):
+            source = _open_source(args)
+        layout_memo_dir = None
+        if args.cache:
+            layout_memo_dir = os.path.join(
+                args.cache_dir or default_cache_dir(), "layouts")
+        Graph(args.packages, (args.configfile, args.configsection),
+              args.output or ([] if args.tiles else ["frame.png"]),
+              source=source,
+              layout_in=args.layout_in, layout_out=args.layout_out,
+              layout_memo_dir=layout_memo_dir,
+              previous_layout=args.incremental, metrics=metrics,
+              coarsen_mode=args.coarsen, focus=args.focus, why=args.why,
+              depth=args.depth, seed=args.seed,
+              layout_trials=args.layout_trials, tiles_dir=args.tiles)
     except util.TreeCLIError as e:
-        sys.stderr.write("ERROR: {}\n".format(e.message))
+        metrics.stats["error"] = str(e)
+        sys.stderr.write("ERROR: {}\n".format(e))
         sys.exit(1)
+    finally:
+        if args.metrics_json is not None:
+            metrics.write(args.metrics_json)
 
 
 if __name__ == "__main__":
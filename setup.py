@@ -17,12 +17,11 @@ setuptools.setup(
     classifiers=[],
     install_requires=[
         "matplotlib>=1.5",
-        "networkx>=1.11",
-        "pygraphviz>=1.3",
-        "pandas>=1.4"
+        "numpy>=1.17"
     ],
     data_files = [],
     entry_points={"console_scripts": [
-        "nix-visualize=nix_visualize.visualize_tree:main"
+        "nix-visualize=nix_visualize.visualize_tree:main",
+        "nix-visualize-daemon=nix_visualize.server:main"
     ]}
 )
@@ -0,0 +1,140 @@
+"""Tests of the graph algorithms on Nodes, against simpler versions"""
+
+import random
+import unittest
+
+from nix_visualize import util
+from nix_visualize.graph_objects import (Node, assign_levels,
+                                         transitive_reduction)
+
+
+def link(names, references):
+    """Return indexed Nodes for names, linked by (dependency, referrer)
+    pairs as Graph._add_edges_to_nodes links them
+    """
+    nodes = [Node(name) for name in names]
+    index = {}
+    for i, n in enumerate(nodes):
+        n.index = i
+        index[n.raw_name] = i
+    for dependency, referrer in references:
+        nfrom = nodes[index[dependency]]
+        nto = nodes[index[referrer]]
+        nfrom.add_parent(nfrom, nto)
+        nto.add_child(nfrom, nto)
+    return nodes
+
+
+def random_dag(size, rng):
+    """Return the names and (dependency, referrer) pairs of a random
+    dependency graph, with a few roots and packages referred to by up to
+    four of the 30 packages before them
+    """
+    names = ["{:032x}-pkg{}".format(rng.getrandbits(128), i)
+             for i in range(size)]
+    references = set()
+    for i in range(1, size):
+        if rng.random() < 0.05:
+            continue
+        for _ in range(rng.randint(1, 4)):
+            references.add((names[i], names[rng.randrange(max(0, i - 30),
+                                                          i)]))
+    # Names are not in dependency order
+    rng.shuffle(names)
+    return names, sorted(references)
+
+
+def recursive_levels(nodes):
+    """Levels as the removed Node.add_level computed them, one recursion per
+    parent
+    """
+    levels = {}
+
+    def level(node):
+        if node.index not in levels:
+            levels[node.index] = max((level(p) for p in node.parents),
+                                     default=-1) + 1
+        return levels[node.index]
+    return [level(n) for n in nodes]
+
+
+class TestAssignLevels(unittest.TestCase):
+
+    def test_matches_recursive_levels(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            nodes = link(*random_dag(rng.randint(1, 200), rng))
+            assign_levels(nodes)
+            self.assertEqual([n.level for n in nodes],
+                             recursive_levels(nodes))
+
+    def test_deep_chain(self):
+        # Far deeper than the recursion limit
+        names = ["pkg{}".format(i) for i in range(20000)]
+        nodes = link(names, zip(names[1:], names))
+        assign_levels(nodes)
+        self.assertEqual([n.level for n in nodes], list(range(20000)))
+
+    def test_cycle(self):
+        # Names without a Nix hash are reported in full
+        nodes = link(["root", "a", "b", "c"],
+                     [("a", "root"), ("b", "a"), ("c", "b"), ("a", "c")])
+        with self.assertRaises(util.TreeCLIError) as raised:
+            assign_levels(nodes)
+        message = str(raised.exception)
+        self.assertIn("3 of 4 nodes", message)
+        cycle = message.rsplit(": ", 1)[1].split(" -> ")
+        self.assertEqual(len(cycle), 4)
+        self.assertEqual(cycle[0], cycle[-1])
+        self.assertEqual(sorted(cycle[:-1]), ["a", "b", "c"])
+
+
+def reachable(node):
+    """Return the indices of every package node depends on, directly or not
+    """
+    seen = set()
+    stack = list(node.children)
+    while stack:
+        child = stack.pop()
+        if child.index not in seen:
+            seen.add(child.index)
+            stack.extend(child.children)
+    return seen
+
+
+def links(nodes):
+    return {(child.index, n.index) for n in nodes for child in n.children}
+
+
+class TestTransitiveReduction(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            nodes = link(*random_dag(rng.randint(1, 120), rng))
+            assign_levels(nodes)
+            before = links(nodes)
+            reach = [reachable(n) for n in nodes]
+            levels = [n.level for n in nodes]
+            degrees = [(n.in_degree, n.out_degree) for n in nodes]
+
+            # A link is redundant when another dependency of the referrer
+            # reaches the same package
+            redundant = {(d, r) for d, r in before
+                         if any(d in reach[c.index]
+                                for c in nodes[r].children if c.index != d)}
+            self.assertEqual(transitive_reduction(nodes), len(redundant))
+            self.assertEqual(links(nodes), before - redundant)
+            self.assertEqual({(c.index, n.index) for n in nodes
+                              for c in n.children},
+                             {(n.index, p.index) for n in nodes
+                              for p in n.parents})
+            self.assertEqual([reachable(n) for n in nodes], reach)
+            self.assertEqual([(n.in_degree, n.out_degree) for n in nodes],
+                             degrees)
+            assign_levels(nodes)
+            self.assertEqual([n.level for n in nodes], levels)
+
+
+if __name__ == "__main__":
+    unittest.main()
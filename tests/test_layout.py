@@ -0,0 +1,244 @@
+"""Tests of the layout solver and of saving and reusing layouts"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from nix_visualize import nixstore, util
+from nix_visualize.layout import (MIN_SIBLING_DISTANCE, NEAR_FIELD_LIMIT,
+                                  LayoutEngine, _inversions, count_crossings,
+                                  read_layout, write_layout)
+from nix_visualize.visualize_tree import Graph
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fixtures")
+
+HELLO = "/nix/store/0x9b6ylm2mlf4yr0mbx4iyzkgl0rnp3i-hello-2.12.1"
+
+
+def write_random_graph(directory, size, seed=1):
+    """Write nix-store --graph output for a random dependency graph of size
+    paths, each referred to by one to four of the 30 paths before it, to
+    directory and return the store path of its root
+    """
+
+    rng = random.Random(seed)
+    names = ["{:032x}-pkg{}-1.{}".format(rng.getrandbits(128), i, i % 7)
+             for i in range(size)]
+    lines = ["digraph G {"]
+    for name in names:
+        lines.append('"{}" [label = "{}", shape = box];'.format(name,
+                                                                 name[33:]))
+    for i in range(1, size):
+        for referrer in sorted(set(rng.randrange(max(0, i - 30), i)
+                                   for _ in range(rng.randint(1, 4)))):
+            lines.append('"{}" -> "{}" [color = "black"];'.format(
+                names[i], names[referrer]))
+    lines.append("}")
+    with open(os.path.join(directory, names[0] + ".dot"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return "/nix/store/" + names[0]
+
+
+class TestLayoutEngines(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def positions(self, package, engine, initializer):
+        configfile = os.path.join(self.tmpdir, engine + ".cfg")
+        with open(configfile, "w") as f:
+            f.write("[layout]\nlayout_engine = {}\ninitializer = {}\n"
+                    "num_iterations = 20\n".format(engine, initializer))
+        graph = Graph([package], (configfile, None), [],
+                      source=nixstore.DotFileSource(self.tmpdir),
+                      layout_out=os.path.join(self.tmpdir, "layout.json"),
+                      seed=5)
+        return np.array([(n.x, n.y) for n in graph.nodes])
+
+    def test_numpy_engine_matches_reference(self):
+        # The reference engine is the original per-node loop, which the
+        # numpy engine must reproduce for the same seed
+        package = write_random_graph(self.tmpdir, 300)
+        for initializer in ("barycentric", "random"):
+            reference = self.positions(package, "reference", initializer)
+            vectorized = self.positions(package, "numpy", initializer)
+            self.assertEqual(reference.shape, (300, 2))
+            self.assertLessEqual(np.abs(vectorized - reference).max(), 1e-9,
+                                 initializer)
+
+
+class TestCrossings(unittest.TestCase):
+
+    def test_inversions(self):
+        rng = random.Random(0)
+        for size in list(range(6)) + [rng.randint(6, 300) for _ in range(100)]:
+            values = [rng.randint(0, rng.choice((1, 5, 1000)))
+                      for _ in range(size)]
+            expected = sum(values[i] > values[j] for i in range(size)
+                           for j in range(i + 1, size))
+            self.assertEqual(_inversions(values), expected, values)
+
+    def test_count_crossings(self):
+        rng = random.Random(1)
+        for _ in range(200):
+            size = rng.randint(1, 60)
+            levels = sorted(rng.randrange(5) for _ in range(size))
+            # Few distinct positions, so ends are often level with each other
+            xs = [float(rng.randrange(rng.choice((3, 10, 100))))
+                  for _ in range(size)]
+            parents = [sorted(set(rng.choice([j for j in range(size)
+                                              if levels[j] < levels[i]])
+                                  for _ in range(rng.randint(0, 3))))
+                       if levels[i] > levels[0] else []
+                       for i in range(size)]
+            parent_ptr = np.cumsum([0] + [len(p) for p in parents])
+            parent_idx = [p for ps in parents for p in ps]
+
+            edges = [(child, parent) for child in range(size)
+                     for parent in parents[child]]
+            expected = 0
+            for i, (c1, p1) in enumerate(edges):
+                for c2, p2 in edges[i + 1:]:
+                    if ((levels[c1], levels[p1]) == (levels[c2], levels[p2])
+                            and (xs[c1] - xs[c2]) * (xs[p1] - xs[p2]) < 0):
+                        expected += 1
+            self.assertEqual(count_crossings(levels, xs, parent_ptr,
+                                             parent_idx), expected)
+
+
+class TestApproximateRepulsion(unittest.TestCase):
+
+    def levels(self):
+        rng = np.random.default_rng(0)
+        return {
+            "uniform": rng.uniform(0, 1000, 3000),
+            # Leaves pulled towards shared parents, far from the rest
+            "clustered": np.concatenate([rng.uniform(0, 5, 3000),
+                                         [-1000, 1000]]),
+            "long tailed": rng.exponential(1, 3000) ** 4,
+            "clumps": np.concatenate([rng.uniform(0, 1e-4, 1500),
+                                      rng.uniform(50, 50.001, 1500), [1e5]]),
+        }
+
+    def test_error_bound(self):
+        # Every far term is off by at most 1/(near_cells + 1) of itself
+        for name, xs in self.levels().items():
+            dist = np.abs(xs[np.newaxis, :] - xs[:, np.newaxis])
+            magnitude = np.where(dist > MIN_SIBLING_DISTANCE, 1 / np.maximum(
+                dist, MIN_SIBLING_DISTANCE), 0).sum(axis=1)
+            exact = LayoutEngine._sibling_force(xs)
+            for near_cells in (1, 8):
+                approximate = LayoutEngine._sibling_force_approximate(
+                    xs, near_cells)
+                error = np.abs(approximate - exact) / magnitude
+                self.assertLessEqual(error.max(), 1 / (near_cells + 1),
+                                     "{} near_cells={}".format(name,
+                                                               near_cells))
+
+    def test_near_field_is_bounded(self):
+        # However nodes cluster, only a few siblings per node are summed
+        # exactly, unless they are within a few MIN_SIBLING_DISTANCE of
+        # many others, as the smallest long tailed ones are
+        near_cells = 8
+        levels = self.levels()
+        del levels["long tailed"]
+        for name, xs in levels.items():
+            with mock.patch.object(LayoutEngine, "_near_field",
+                                   wraps=LayoutEngine._near_field) as near:
+                LayoutEngine._sibling_force_approximate(xs, near_cells)
+            pairs = sum(int((last - first).sum()) for (_xs, _order, _owners,
+                                                       first, last), _kw
+                        in near.call_args_list)
+            self.assertLessEqual(pairs, len(xs) * NEAR_FIELD_LIMIT *
+                                 (2 * near_cells + 1), name)
+
+
+class TestLayoutMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.memo_dir = os.path.join(self.tmpdir, "layouts")
+
+    def graph(self, **kwargs):
+        kwargs.setdefault("layout_out", os.path.join(self.tmpdir, "out.json"))
+        return Graph([HELLO], (None, None), [],
+                     source=nixstore.DotFileSource(FIXTURES),
+                     layout_memo_dir=self.memo_dir, **kwargs)
+
+    def memo(self):
+        (name,) = os.listdir(self.memo_dir)
+        return os.path.join(self.memo_dir, name)
+
+    def test_memo_is_reused(self):
+        first = self.graph()
+        self.assertEqual(first.metrics.stats["layout_source"], "computed")
+        second = self.graph()
+        self.assertEqual(second.metrics.stats["layout_source"], "memo")
+        self.assertEqual([(n.x, n.y) for n in first.nodes],
+                         [(n.x, n.y) for n in second.nodes])
+
+    def test_truncated_memo_is_recomputed(self):
+        self.graph()
+        memo = self.memo()
+        with open(memo) as f:
+            text = f.read()
+        with open(memo, "w") as f:
+            f.write(text[:len(text) // 2])
+
+        with self.assertLogs("nix_visualize.visualize_tree", "WARNING"):
+            graph = self.graph()
+        self.assertEqual(graph.metrics.stats["layout_source"], "computed")
+        self.assertEqual(read_layout(memo)["names"],
+                         [n.raw_name for n in graph.nodes])
+
+    def test_memo_of_other_graph_is_recomputed(self):
+        self.graph()
+        memo = self.memo()
+        layout = read_layout(memo)
+        layout["graph_hash"] = "0" * 64
+        write_layout(memo, layout)
+
+        with self.assertLogs("nix_visualize.visualize_tree", "WARNING"):
+            graph = self.graph()
+        self.assertEqual(graph.metrics.stats["layout_source"], "computed")
+
+    def test_truncated_layout_in_fails(self):
+        layout = os.path.join(self.tmpdir, "layout.json")
+        self.graph(layout_out=layout)
+        with open(layout, "r+") as f:
+            f.truncate(10)
+        with self.assertRaises(util.TreeCLIError):
+            self.graph(layout_in=layout)
+
+
+class TestWriteLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "layout.json")
+
+    def test_round_trip(self):
+        write_layout(self.filename, {"names": ["a"], "x": [1.5]})
+        layout = read_layout(self.filename)
+        self.assertEqual((layout["names"], layout["x"]), (["a"], [1.5]))
+        self.assertEqual(os.listdir(self.tmpdir), ["layout.json"])
+
+    def test_failed_write_keeps_old_layout(self):
+        write_layout(self.filename, {"names": ["a"]})
+        with self.assertRaises(TypeError):
+            write_layout(self.filename, {"names": [object()]})
+        self.assertEqual(read_layout(self.filename)["names"], ["a"])
+        self.assertEqual(os.listdir(self.tmpdir), ["layout.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
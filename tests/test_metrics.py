@@ -0,0 +1,44 @@
+"""Tests of the measurements of the phases of a run"""
+
+import unittest
+
+from nix_visualize import metrics
+
+
+def _touch(size):
+    """Return size bytes of memory that are resident"""
+    buf = bytearray(size)
+    buf[::4096] = b"x" * len(buf[::4096])
+    return buf
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+        with self.metrics.phase("big"):
+            buf = _touch(200 * 10**6)
+            del buf
+        with self.metrics.phase("small"):
+            pass
+        self.big, self.small = self.metrics.phases
+
+    def test_own_peak(self):
+        if self.big["peak_rss_mb"] is None:
+            self.skipTest("the peak RSS cannot be reset here")
+        self.assertGreater(self.big["peak_rss_mb"], 200)
+        # The memory of the phase before is not counted again
+        self.assertLess(self.small["peak_rss_mb"],
+                        self.big["peak_rss_mb"] - 150)
+
+    def test_peak_so_far(self):
+        self.assertGreater(self.big["peak_rss_mb_so_far"], 200)
+        self.assertEqual(self.small["peak_rss_mb_so_far"],
+                         self.big["peak_rss_mb_so_far"])
+        self.assertGreaterEqual(
+            self.metrics.to_dict()["total"]["peak_rss_mb"],
+            self.big["peak_rss_mb_so_far"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+"""Tests of reading closures from a database with the Nix store schema"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from nix_visualize import nixstore, server, util, visualize_tree
+from nix_visualize.cache import STORE_DIR
+from nix_visualize.nixdb import NixDatabase
+
+HELLO = "0x9b6ylm2mlf4yr0mbx4iyzkgl0rnp3i-hello-2.12.1"
+GLIBC = "hk6ka7ksfd3gwz3qvgl8l4b5v6ixdfa2-glibc-2.37-8"
+LIBIDN2 = "y4kbknmxdhl25ng0dcdlg2dzsbyrhcbf-libidn2-2.3.4"
+LIBUNISTRING = "3dw1c4llvvw9jp5i4mdlvbyyxb8a4z4l-libunistring-1.1"
+LIBGCC = "4a0x1ij8c0bj6nkgf2dvcbzivmzqvc7r-xgcc-12.3.0-libgcc"
+BASH = "1ab5xmr3cfg5h8fbrmq7i0fz3ykwyiqx-bash-5.2-p15"
+MISSING = "7rjk1d3cmkrzwcd6fk0yn7d8mhhlmjyw-not-in-the-store-1.0"
+
+HELLO_CLOSURE = ({HELLO, GLIBC, LIBIDN2, LIBUNISTRING, LIBGCC},
+                 {(GLIBC, HELLO), (LIBIDN2, GLIBC), (LIBGCC, GLIBC),
+                  (LIBUNISTRING, LIBIDN2)})
+
+#: The tables of a Nix store database (nix/src/libstore/schema.sql) that
+#: are read, and the index Nix keeps on Refs
+SCHEMA = """
+CREATE TABLE ValidPaths (
+    id               integer primary key autoincrement not null,
+    path             text unique not null,
+    hash             text not null,
+    registrationTime integer not null,
+    deriver          text,
+    narSize          integer,
+    ultimate         integer,
+    sigs             text,
+    ca               text
+);
+CREATE TABLE Refs (
+    referrer  integer not null,
+    reference integer not null,
+    primary key (referrer, reference),
+    foreign key (referrer) references ValidPaths(id) on delete cascade,
+    foreign key (reference) references ValidPaths(id) on delete restrict
+);
+CREATE INDEX IndexReferrer ON Refs(referrer);
+CREATE INDEX IndexReference ON Refs(reference);
+"""
+
+#: The references of every path in the store, including the references of
+#: paths to themselves that Nix records
+REFERENCES = {
+    HELLO: [HELLO, GLIBC],
+    GLIBC: [GLIBC, LIBIDN2, LIBGCC],
+    LIBIDN2: [LIBIDN2, LIBUNISTRING],
+    LIBUNISTRING: [LIBUNISTRING],
+    LIBGCC: [],
+    BASH: [BASH, GLIBC],
+}
+
+
+def make_nix_db(filename, references=REFERENCES):
+    """Write a Nix store database holding references, a dictionary of the
+    references of every path, in WAL mode like the one Nix keeps
+    """
+
+    db = sqlite3.connect(filename)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.executescript(SCHEMA)
+    ids = {}
+    for name in references:
+        ids[name] = db.execute(
+            "INSERT INTO ValidPaths (path, hash, registrationTime, narSize) "
+            "VALUES (?, ?, 0, 0)",
+            (os.path.join(STORE_DIR, name), "sha256:" + name[:32])).lastrowid
+    db.executemany("INSERT INTO Refs (referrer, reference) VALUES (?, ?)",
+                   [(ids[referrer], ids[reference])
+                    for referrer, refs in references.items()
+                    for reference in refs])
+    db.commit()
+    db.close()
+
+
+def _closures(results):
+    closures = []
+    for _rank, _package, closure, error in sorted(results,
+                                                  key=lambda r: r[0]):
+        if error is not None:
+            closures.append(error)
+            continue
+        nodes, edges = closure
+        closures.append(({n.raw_name for n in nodes},
+                         {(e.nfrom, e.nto) for e in edges}))
+    return closures
+
+
+class TestNixDatabase(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.filename = os.path.join(tmpdir, "db.sqlite")
+        make_nix_db(self.filename)
+        self.db = NixDatabase(self.filename)
+        self.addCleanup(self.db.close)
+
+    def query(self, *names):
+        return _closures(self.db.query_closures(
+            [os.path.join(STORE_DIR, name) for name in names]))
+
+    def test_closure(self):
+        # References of paths to themselves are not dependencies
+        self.assertEqual(self.query(HELLO), [HELLO_CLOSURE])
+
+    def test_file_inside_store_path(self):
+        # Like nix-store -q, a file inside a store path stands for it
+        self.assertEqual(self.query(os.path.join(HELLO, "bin", "hello")),
+                         [HELLO_CLOSURE])
+
+    def test_multiple_roots(self):
+        # Paths shared with an earlier root belong to that root only
+        self.assertEqual(self.query(HELLO, BASH, LIBIDN2), [
+            HELLO_CLOSURE, ({BASH}, {(GLIBC, BASH)}), (set(), set())])
+
+    def test_root_not_in_store(self):
+        hello, missing, bash = self.query(HELLO, MISSING, BASH)
+        self.assertIsInstance(missing, util.TreeCLIError)
+        self.assertIn(MISSING, str(missing))
+        self.assertEqual(hello, HELLO_CLOSURE)
+        self.assertEqual(bash, ({BASH}, {(GLIBC, BASH)}))
+
+    def test_root_not_in_store_falls_back(self):
+        missing = os.path.join(STORE_DIR, MISSING)
+        self.db.fallback = server.StaticSource({missing: ([MISSING], [])})
+        self.assertEqual(self.query(HELLO, MISSING, BASH), [
+            HELLO_CLOSURE, ({MISSING}, set()), ({BASH}, {(GLIBC, BASH)})])
+
+    def test_failed_query(self):
+        writable = sqlite3.connect(self.filename)
+        writable.execute("DROP TABLE Refs")
+        writable.commit()
+        writable.close()
+        for result in self.query(HELLO, BASH):
+            self.assertIsInstance(result, util.TreeCLIError)
+            self.assertIn("Refs", str(result))
+
+        self.db.fallback = server.StaticSource({
+            os.path.join(STORE_DIR, name): ([name], [])
+            for name in (HELLO, BASH)})
+        self.assertEqual(self.query(HELLO, BASH),
+                         [({HELLO}, set()), ({BASH}, set())])
+
+    def test_opened_read_only(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.db.execute("DELETE FROM Refs")
+
+
+class TestOpenSource(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def open_source(self, source, nix_db):
+        args = argparse.Namespace(source=source, nix_db=nix_db, cache=False,
+                                  cache_dir=None, cache_size=None, jobs=1)
+        source = visualize_tree._open_source(args)
+        if isinstance(source, NixDatabase):
+            self.addCleanup(source.close)
+        return source
+
+    def test_database(self):
+        filename = os.path.join(self.tmpdir, "db.sqlite")
+        make_nix_db(filename)
+        source = self.open_source("auto", filename)
+        self.assertIsInstance(source, NixDatabase)
+        self.assertIsInstance(source.fallback, nixstore.NixStoreSource)
+        source = self.open_source("db", filename)
+        self.assertIsInstance(source, NixDatabase)
+        self.assertIsNone(source.fallback)
+
+    def test_auto_falls_back_to_nix_store(self):
+        not_a_db = os.path.join(self.tmpdir, "not-a-db.sqlite")
+        with open(not_a_db, "w") as f:
+            f.write("this is not an SQLite database\n" * 100)
+        for filename in (os.path.join(self.tmpdir, "missing.sqlite"),
+                         not_a_db):
+            self.assertIsInstance(self.open_source("auto", filename),
+                                  nixstore.NixStoreSource)
+
+    def test_db_does_not_fall_back(self):
+        with self.assertRaises(util.TreeCLIError):
+            self.open_source("db", os.path.join(self.tmpdir,
+                                                "missing.sqlite"))
+
+
+if __name__ == "__main__":
+    unittest.main()
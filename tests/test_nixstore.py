@@ -0,0 +1,136 @@
+"""Tests of the nix-store output parsers against recorded output"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from nix_visualize import nixstore, util
+from nix_visualize.graph_objects import Edge
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fixtures")
+
+HELLO = "0x9b6ylm2mlf4yr0mbx4iyzkgl0rnp3i-hello-2.12.1"
+GLIBC = "hk6ka7ksfd3gwz3qvgl8l4b5v6ixdfa2-glibc-2.37-8"
+LIBIDN2 = "y4kbknmxdhl25ng0dcdlg2dzsbyrhcbf-libidn2-2.3.4"
+LIBUNISTRING = "3dw1c4llvvw9jp5i4mdlvbyyxb8a4z4l-libunistring-1.1"
+LIBGCC = "4a0x1ij8c0bj6nkgf2dvcbzivmzqvc7r-xgcc-12.3.0-libgcc"
+
+#: The output of nix-store -q --graph for hello, recorded in fixtures
+HELLO_GRAPH = os.path.join(FIXTURES, HELLO + ".dot")
+
+#: Nodes in the order they are first mentioned, and (dependency, referrer)
+#: pairs in the order they are listed
+HELLO_NODES = [HELLO, GLIBC, LIBIDN2, LIBGCC, LIBUNISTRING]
+HELLO_EDGES = [(GLIBC, HELLO), (LIBIDN2, GLIBC), (LIBGCC, GLIBC),
+               (LIBUNISTRING, LIBIDN2)]
+
+#: Prints a graph fixture like nix-store, after 1 MB of warnings, far more
+#: than a pipe holds
+NOISY_NIX_STORE = """#!{python}
+import sys
+for i in range(20000):
+    sys.stderr.write("warning: line {{}} of a lot of noise\\n".format(i))
+sys.stderr.flush()
+with open("{graph}") as f:
+    sys.stdout.write(f.read())
+sys.exit(int(sys.argv[3] == "fail"))
+"""
+
+
+def _split(records):
+    records = list(records)
+    nodes = [r.raw_name for r in records if not isinstance(r, Edge)]
+    edges = [(r.nfrom, r.nto) for r in records if isinstance(r, Edge)]
+    return nodes, edges
+
+
+class TestParseGraph(unittest.TestCase):
+
+    def test_recorded_graph(self):
+        with open(HELLO_GRAPH, "rb") as f:
+            nodes, edges = _split(nixstore.parse_graph(f))
+        self.assertEqual(nodes, HELLO_NODES)
+        self.assertEqual(edges, HELLO_EDGES)
+
+    def test_matches_pygraphviz(self):
+        try:
+            import pygraphviz
+        except ImportError:
+            self.skipTest("pygraphviz is not installed")
+        graph = pygraphviz.AGraph(HELLO_GRAPH)
+        with open(HELLO_GRAPH, "rb") as f:
+            nodes, edges = _split(nixstore.parse_graph(f))
+        self.assertEqual(set(nodes), set(graph.nodes()))
+        self.assertEqual(sorted(edges), sorted(graph.edges()))
+
+    def test_quoted_and_bare_names(self):
+        lines = ['digraph G {',
+                 '"a-b\\"c" [label = "x"];',
+                 'bare-1.0 -> "a-b\\"c" [color = "red"];',
+                 '}']
+        self.assertEqual(_split(nixstore.parse_graph(lines)),
+                         (['a-b"c', "bare-1.0"], [("bare-1.0", 'a-b"c')]))
+
+    def test_bad_line(self):
+        with self.assertRaises(util.TreeCLIError):
+            list(nixstore.parse_graph(["digraph G {", "not dot at all {"]))
+
+
+class TestParsePaths(unittest.TestCase):
+
+    def test_references(self):
+        # A path's references can include the path itself, which is not a
+        # dependency
+        with open(os.path.join(FIXTURES, "hello-2.12.1.references")) as f:
+            nodes, edges = _split(nixstore.parse_paths(
+                f, "/nix/store/" + HELLO))
+        self.assertEqual(nodes, [HELLO, GLIBC])
+        self.assertEqual(edges, [(GLIBC, HELLO)])
+
+    def test_requisites(self):
+        with open(os.path.join(FIXTURES, "hello-2.12.1.requisites")) as f:
+            nodes, edges = _split(nixstore.parse_paths(f))
+        self.assertEqual(sorted(nodes), sorted(HELLO_NODES))
+        self.assertEqual(edges, [])
+
+    def test_output_format_is_detected(self):
+        with open(HELLO_GRAPH, "rb") as f:
+            self.assertEqual(_split(nixstore.parse_output(f)),
+                             (HELLO_NODES, HELLO_EDGES))
+        with open(os.path.join(FIXTURES, "hello-2.12.1.references")) as f:
+            self.assertEqual(_split(nixstore.parse_output(f, HELLO)),
+                             ([HELLO, GLIBC], [(GLIBC, HELLO)]))
+        self.assertEqual(_split(nixstore.parse_output(["", "  "])), ([], []))
+
+
+class TestQueryGraph(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        stub = os.path.join(tmpdir, "nix-store")
+        with open(stub, "w") as f:
+            f.write(NOISY_NIX_STORE.format(python=sys.executable,
+                                           graph=HELLO_GRAPH))
+        os.chmod(stub, 0o755)
+        path = os.environ["PATH"]
+        os.environ["PATH"] = tmpdir + os.pathsep + path
+        self.addCleanup(os.environ.__setitem__, "PATH", path)
+
+    def test_lots_of_warnings(self):
+        nodes, edges = nixstore.query_closure("/nix/store/" + HELLO)
+        self.assertEqual([n.raw_name for n in nodes], HELLO_NODES)
+        self.assertEqual([(e.nfrom, e.nto) for e in edges], HELLO_EDGES)
+
+    def test_failure_reports_stderr(self):
+        with self.assertRaises(util.TreeCLIError) as raised:
+            nixstore.query_closure("fail")
+        self.assertIn("warning: line 19999 of a lot of noise",
+                      str(raised.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+"""Tests of the daemon, run against stub graph sources instead of Nix"""
+
+import csv
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from nix_visualize import cache, nixstore, server
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fixtures")
+
+HELLO_NAME = "0x9b6ylm2mlf4yr0mbx4iyzkgl0rnp3i-hello-2.12.1"
+HELLO = os.path.join(cache.STORE_DIR, HELLO_NAME)
+HELLO_CLOSURE = {
+    HELLO_NAME,
+    "hk6ka7ksfd3gwz3qvgl8l4b5v6ixdfa2-glibc-2.37-8",
+    "y4kbknmxdhl25ng0dcdlg2dzsbyrhcbf-libidn2-2.3.4",
+    "3dw1c4llvvw9jp5i4mdlvbyyxb8a4z4l-libunistring-1.1",
+    "4a0x1ij8c0bj6nkgf2dvcbzivmzqvc7r-xgcc-12.3.0-libgcc",
+}
+
+#: Stands in for nix-store -q --graph <path>, printing the fixture of the
+#: path and counting its calls
+STUB_NIX_STORE = """#!/bin/sh
+echo "$3" >> "{calls}"
+exec cat "{fixtures}/$(basename "$3").dot"
+"""
+
+
+class ServiceTestCase(unittest.TestCase):
+    """Runs a daemon on a free port for every test"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def serve(self, source, configfile=None):
+        service = server.VisualizationService(source, configfile)
+        httpd = server.HTTPServer(("127.0.0.1", 0), server.RequestHandler)
+        httpd.service = service
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+
+        def stop():
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+            service.close()
+        self.addCleanup(stop)
+        return httpd.server_address[1]
+
+    def get(self, port, url, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        self.addCleanup(connection.close)
+        connection.request("GET", url, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def read_csv(self, body):
+        return list(csv.reader(body.decode("utf-8").splitlines()))
+
+    def assertHelloCSV(self, body):
+        rows = self.read_csv(body)
+        self.assertEqual(rows[0][0], "raw_name")
+        self.assertEqual({row[0] for row in rows[1:]}, HELLO_CLOSURE)
+
+    def write_stub_nix_store(self):
+        bindir = os.path.join(self.tmpdir, "bin")
+        os.mkdir(bindir)
+        calls = os.path.join(self.tmpdir, "calls")
+        stub = os.path.join(bindir, "nix-store")
+        with open(stub, "w") as f:
+            f.write(STUB_NIX_STORE.format(calls=calls, fixtures=FIXTURES))
+        os.chmod(stub, 0o755)
+        path = os.environ["PATH"]
+        os.environ["PATH"] = bindir + os.pathsep + path
+        self.addCleanup(os.environ.__setitem__, "PATH", path)
+        return calls
+
+
+class TestServer(ServiceTestCase):
+
+    def test_dot_file_source(self):
+        port = self.serve(nixstore.DotFileSource(FIXTURES))
+        response, body = self.get(port, "/graph?path={}&format=csv".format(
+            HELLO))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"),
+                         "text/csv; charset=utf-8")
+        self.assertEqual(response.getheader("Cache-Control"),
+                         server.IMMUTABLE)
+        self.assertHelloCSV(body)
+
+        etag = response.getheader("ETag")
+        response, body = self.get(port, "/graph?path={}&format=csv".format(
+            HELLO), {"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, b"")
+
+    def test_nix_store_source_with_cache(self):
+        calls = self.write_stub_nix_store()
+        closures = cache.ClosureCache(os.path.join(self.tmpdir, "cache"))
+        self.addCleanup(closures.close)
+
+        # Requests are answered on other threads than the one that opened
+        # the cache
+        port = self.serve(nixstore.NixStoreSource(1, closures))
+        response, body = self.get(port, "/graph?path={}&format=csv".format(
+            HELLO))
+        self.assertEqual(response.status, 200, body)
+        self.assertHelloCSV(body)
+        nodes, _edges = closures.get(HELLO_NAME)
+        self.assertEqual({n.raw_name for n in nodes}, HELLO_CLOSURE)
+
+        # A new daemon finds the closure in the cache
+        port = self.serve(nixstore.NixStoreSource(1, closures))
+        response, body = self.get(port, "/graph?path={}&format=jsonl".format(
+            HELLO))
+        self.assertEqual(response.status, 200, body)
+        with open(calls) as f:
+            self.assertEqual(f.read().split(), [HELLO])
+
+    def test_not_modified_without_drawing(self):
+        port = self.serve(nixstore.DotFileSource(FIXTURES))
+        url = "/graph?path={}&format=csv".format(HELLO)
+        etag = self.get(port, url)[0].getheader("ETag")
+
+        # A restarted daemon answers from the request alone, without
+        # querying the closure again
+        port = self.serve(nixstore.DotFileSource(self.tmpdir))
+        response, body = self.get(port, url, {"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.getheader("ETag"), etag)
+        self.assertEqual(response.getheader("Cache-Control"),
+                         server.IMMUTABLE)
+        response, body = self.get(port, url)
+        self.assertEqual(response.status, 400)
+
+    def test_render_is_reproducible(self):
+        # The same key is served with the same strong ETag, so drawing it
+        # again must give the same bytes
+        closures = {HELLO: (sorted(HELLO_CLOSURE), [])}
+        # render sets the environment of the worker process it runs in
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        for fmt in ("png", "svg"):
+            first, second = [server.render([HELLO], closures, (None, None),
+                                           fmt, "0123456789abcdef" * 4)
+                             for _ in range(2)]
+            self.assertEqual(first, second, fmt)
+
+    def test_config_change_changes_etag(self):
+        configfile = os.path.join(self.tmpdir, "config.cfg")
+        with open(configfile, "w") as f:
+            f.write("[style]\ncolor_map = rainbow\n")
+        port = self.serve(nixstore.DotFileSource(FIXTURES), configfile)
+        url = "/graph?path={}&format=csv&section=style".format(HELLO)
+        response, _body = self.get(port, url)
+        self.assertEqual(response.status, 200)
+        etag = response.getheader("ETag")
+
+        with open(configfile, "w") as f:
+            f.write("[style]\ncolor_map = viridis\n")
+        response, _body = self.get(port, url, {"If-None-Match": etag})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.getheader("ETag"), etag)
+
+    def test_static_source(self):
+        source = server.StaticSource({"pkg": (["a-pkg", "b-dep"],
+                                              [("b-dep", "a-pkg")])})
+        port = self.serve(source)
+        response, body = self.get(port, "/graph?path=pkg&format=csv")
+        self.assertEqual(response.status, 200)
+        # Not a store path, so it may change and is not cached
+        self.assertEqual(response.getheader("Cache-Control"), "no-cache")
+        self.assertIsNone(response.getheader("ETag"))
+        self.assertEqual(self.read_csv(body)[1:],
+                         [["b-dep", "1", "0", "1"], ["a-pkg", "0", "1", "0"]])
+
+    def test_unknown_path(self):
+        port = self.serve(nixstore.DotFileSource(FIXTURES))
+        response, body = self.get(port, "/graph?path=/nix/store/missing")
+        self.assertEqual(response.status, 400)
+        self.assertIn(b"missing", body)
+
+
+if __name__ == "__main__":
+    unittest.main()